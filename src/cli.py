@@ -17,8 +17,26 @@
 # along with Coremic. If not, see <http://www.gnu.org/licenses/>.
 import argparse
 import logging
-from core.process_data import process, format_results
+from functools import partial
+from core.process_data import (process, sweep, sweep_cfgs, one_vs_rest,
+                               contrasts, format_results,
+                               format_sweep_results)
 from core.parse_inputs import parse_inputs
+from core.table_cache import TableCache
+from core.executor import run_parallel, chunks
+
+
+def float_list(s):
+    """Parse a comma separated list of floats"""
+    return [float(v) for v in s.split(',')]
+
+
+def non_negative_int(s):
+    """Parse an integer that is at least 0"""
+    value = int(s)
+    if value < 0:
+        raise argparse.ArgumentTypeError('%s is less than 0' % s)
+    return value
 
 
 def setup_parser():
@@ -37,30 +55,58 @@ def setup_parser():
                                            'SampleID to a group'))
     parser.add_argument('datafiles', nargs='+', metavar='datafile',
                         help='BIOM file containing the data to be analyzed')
-    parser.add_argument('-p', '--max_p_val', type=float, metavar='pval',
-                        default=0.05, help=('Maximum p-value to include in ' +
-                                            'the results; defaults to 0.05'))
-    parser.add_argument('-t', '--min_presence', type=float, metavar='presence',
-                        default=0.9, help=('Minimum fractional presence in ' +
-                                           'the interest group; defaults to ' +
-                                           '0.9 (90%%)'))
-    parser.add_argument('-o', '--max_out_presence', type=float,
+    parser.add_argument('-p', '--max_p_val', type=float_list, metavar='pval',
+                        default=[0.05], help=('Maximum p-value to include ' +
+                                              'in the results; defaults to ' +
+                                              '0.05'))
+    parser.add_argument('-t', '--min_presence', type=float_list,
+                        metavar='presence',
+                        default=[0.9], help=('Minimum fractional presence ' +
+                                             'in the interest group; ' +
+                                             'defaults to 0.9 (90%%)'))
+    parser.add_argument('-o', '--max_out_presence', type=float_list,
                         metavar='presence',
-                        default=1.0, help=('Maximum fractional presence in ' +
-                                           'the out group; defaults to ' +
-                                           '1.0 (100%%)'))
-    parser.add_argument('-a', '--max_absent_abundance', type=float,
+                        default=[1.0], help=('Maximum fractional presence ' +
+                                             'in the out group; defaults to ' +
+                                             '1.0 (100%%)'))
+    parser.add_argument('-l', '--long', dest='long', action='store_true',
+                        help=('When sweeping over several values of -p, ' +
+                              '-t, -o, or -a (given separated by commas), ' +
+                              'or with --one-vs-rest, output a single ' +
+                              'table with a row for each core OTU of each ' +
+                              'group and combination, instead of the ' +
+                              'results of each in turn'))
+    batch = parser.add_mutually_exclusive_group()
+    batch.add_argument('--one-vs-rest', dest='one_vs_rest',
+                       action='store_true',
+                       help=('Find the core of every group of the factor ' +
+                             'against the rest of the samples, instead of ' +
+                             'just that of the given group, which is ' +
+                             'ignored'))
+    batch.add_argument('--contrasts', dest='contrasts', action='store_true',
+                       help=('Find the core of every group of the factor ' +
+                             'relative to each other group, ignoring the ' +
+                             'samples in neither. The given group is ' +
+                             'ignored, and the results are output as a ' +
+                             'single table as with --long'))
+    parser.add_argument('-a', '--max_absent_abundance', type=float_list,
                         metavar='abundance',
-                        default=0.0, help=('Any abundance greater than this ' +
-                                           'value is considered to indicate ' +
-                                           'that the corresponding OTU is ' +
-                                           'present; defaults to 0'))
+                        default=[0.0], help=('Any abundance greater than ' +
+                                             'this value is considered to ' +
+                                             'indicate that the ' +
+                                             'corresponding OTU is present; ' +
+                                             'defaults to 0'))
     parser.add_argument('-c', '--p_val_correction', default='b-h',
-                        choices=['none', 'bf', 'bf-h', 'b-h'],
+                        choices=['none', 'bf', 'bf-h', 'b-h', 'b-y'],
                         help=('The method to use for correcting for ' +
                               'multiple testing; valid options are "none", ' +
                               '"bf" (Bonferroni), "bf-h" (Bonferroni-Holm), ' +
-                              'and "b-h" (Benjamini-Hochberg, the default)'))
+                              '"b-h" (Benjamini-Hochberg, the default), ' +
+                              'and "b-y" (Benjamini-Yekutieli)'))
+    parser.add_argument('-n', '--top', type=non_negative_int, metavar='N',
+                        help=('Only report the N core OTUs with the ' +
+                              'greatest interest group presence; defaults ' +
+                              'to reporting all of them'))
     parser.add_argument('-r', '--relative', dest='relative',
                         action='store_true',
                         help=('Convert the input datatable to relative ' +
@@ -75,8 +121,36 @@ def setup_parser():
                         help=('Quantile normalize the columns of the input ' +
                               'datatable before processing. This will occur ' +
                               'after relativising if both are selected. ' +
-                              'Ties are broken in an arbitrary but ' +
-                              'deterministic fashion.'))
+                              'Ties are broken by row order unless ' +
+                              '--quantile-ties is set to average.'))
+    parser.add_argument('--quantile-ties', dest='quantile_ties',
+                        default='first', choices=['first', 'average'],
+                        help=('How quantile normalization treats tied ' +
+                              'values; "first" (the default) gives them ' +
+                              'the values of their ranks in row order, ' +
+                              '"average" gives them all the average value ' +
+                              'of their ranks'))
+    parser.add_argument('-j', '--processes', type=int, metavar='N',
+                        default=1,
+                        help=('Number of processes to spread the work ' +
+                              'over, by group with --one-vs-rest or ' +
+                              '--contrasts and by abundance threshold ' +
+                              'otherwise; defaults to 1'))
+    parser.add_argument('--block-size', dest='block_size', type=float,
+                        metavar='MB', default=16,
+                        help=('Size in megabytes of the blocks of OTUs ' +
+                              'processed at a time, which bounds the ' +
+                              'memory used beyond that of the table and ' +
+                              'the statistics of its OTUs; defaults to 16'))
+    parser.add_argument('--cache-dir', dest='cache_dir', metavar='directory',
+                        help=('Directory in which to cache parsed ' +
+                              'datafiles, so that later runs on the same ' +
+                              'datafiles with the same normalization and ' +
+                              'groupfile samples skip parsing them'))
+    parser.add_argument('--cache-size', dest='cache_size', type=float,
+                        metavar='MB', default=1024,
+                        help=('Maximum size of the cache directory in ' +
+                              'megabytes; defaults to 1024'))
     parser.set_defaults(relative=False)
     return parser
 
@@ -84,25 +158,30 @@ def setup_parser():
 if __name__ == '__main__':
     parser = setup_parser()
     args = parser.parse_args()
-    datafiles = list()
-    for datafile in args.datafiles:
-        with open(datafile) as f:
-            datafiles.append(f.read())
+    # The datafiles are read incrementally while they are parsed
+    datafiles = [open(datafile, 'rb') for datafile in args.datafiles]
     with open(args.groupfile) as f:
         groupfile = f.read().split('\n')
     cfg = {
         'factor': args.factor,
-        'group': map(lambda s: s.strip(), args.group.split(',')),
+        'group': ([] if args.one_vs_rest or args.contrasts
+              else map(lambda s: s.strip(), args.group.split(','))),
         'min_abundance': args.max_absent_abundance,
         'max_p': args.max_p_val,
         'min_frac': args.min_presence,
         'max_out_presence': args.max_out_presence,
         'p_val_adj': args.p_val_correction,
+        'top': args.top,
         'make_relative': args.relative,
         'quantile_normalize': args.quantile_normalize,
+        'quantile_ties': args.quantile_ties,
     }
+    table_cache = (TableCache(args.cache_dir, int(args.cache_size * 2**20))
+                   if args.cache_dir else None)
     errors_list, mapping_dict, out_group, filtered_data = parse_inputs(
-        cfg, groupfile, datafiles)
+        cfg, groupfile, datafiles, table_cache)
+    for f in datafiles:
+        f.close()
     if len(errors_list) > 0:
         logging.error(errors_list)
         exit(1)
@@ -111,6 +190,33 @@ if __name__ == '__main__':
         'mapping_dict': mapping_dict,
         'filtered_data': filtered_data,
     }
-    core = process(inputs, cfg)
-    print(format_results(core, cfg))
+    task = (contrasts if args.contrasts
+            else one_vs_rest if args.one_vs_rest else sweep)
+    points = sweep_cfgs(cfg)
+    chunk_bytes = int(args.block_size * 2**20)
+    if task is sweep and len(points) == 1:
+        results = [(points[0], process(inputs, points[0],
+                                       chunk_bytes=chunk_bytes))]
+    elif args.processes > 1:
+        # Each worker densifies the shared table a block at a time
+        if task is sweep:
+            cfgs = [dict(cfg, min_abundance=thresholds)
+                    for thresholds in chunks(cfg['min_abundance'],
+                                             args.processes)]
+        else:
+            cfgs = [dict(cfg, levels=levels)
+                    for levels in chunks(sorted(mapping_dict),
+                                         args.processes)]
+        results = [result for part in run_parallel(
+            partial(task, chunk_bytes=chunk_bytes), inputs, cfgs,
+            args.processes) for result in part]
+    else:
+        results = task(inputs, cfg, chunk_bytes)
+    if args.contrasts:
+        print(format_sweep_results(results, cfg, pairs=True))
+    elif args.long:
+        print(format_sweep_results(results, cfg))
+    else:
+        print('\n\n'.join(format_results(core, point_cfg)
+                           for point_cfg, core in results))
     exit(0)
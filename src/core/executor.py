@@ -0,0 +1,67 @@
+# Copyright 2016, 2017 Richard Rodrigues, Nyle Rodgers, Mark Williams,
+# Virginia Tech
+#
+# This file is part of Coremic.
+#
+# Coremic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Coremic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Coremic. If not, see <http://www.gnu.org/licenses/>.
+
+
+import shutil
+import tempfile
+import multiprocessing
+
+from table_cache import save_table, load_table
+
+# The inputs of the tasks run by this worker process
+worker_inputs = None
+
+
+def run_parallel(task, inputs, cfgs, processes=None):
+    """Call task(inputs, cfg) for each of cfgs across a pool of processes,
+    defaulting to one for each CPU. task must be a module level function, or
+    a partial of one, so that it can be sent to the workers. The table of
+    inputs is written once to memory mapped files that every worker shares,
+    rather than being copied to each. Returns the results in the same order
+    as cfgs"""
+    directory = tempfile.mkdtemp()
+    try:
+        save_table(directory, inputs['filtered_data'])
+        pool = multiprocessing.Pool(
+            processes, initializer=init_worker,
+            initargs=(directory, dict(inputs, filtered_data=None)))
+        try:
+            return pool.map(run_task, [(task, cfg) for cfg in cfgs],
+                            chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def init_worker(directory, inputs):
+    global worker_inputs
+    worker_inputs = dict(inputs, filtered_data=load_table(directory))
+
+
+def run_task(args):
+    task, cfg = args
+    return task(worker_inputs, cfg)
+
+
+def chunks(items, n):
+    """Split the list items into at most n contiguous lists of nearly equal
+    length"""
+    size = -(-len(items) // n) if items else 1
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
@@ -1,89 +1,250 @@
 import numpy
-from functools import total_ordering
-
-
-def present(values, min_abundance):
-    """Replaces all non-present values with None"""
-    return [v if v > min_abundance else None for v in values]
-
-
-def absent(values, min_abundance):
-    """Replaces all non-absent values with None"""
-    return [v if v <= min_abundance else None for v in values]
-
-
-def interest(values, i_indexes):
-    """Replaces all non-interest values with None"""
-    return [v if i in i_indexes else None for i, v in enumerate(values)]
-
-
-def out(values, i_indexes):
-    """Replaces all non-out values with None"""
-    return [v if i not in i_indexes else None for i, v in enumerate(values)]
-
-
-def mean(values):
-    """Calculate the mean of the given list of values. None values are treated
-    as not existing"""
-    return numpy.mean([v for v in values if v is not None])
-
-
-def count(values):
-    """Number of non-None values in values"""
-    return len([v for v in values if v is not None])
-
-
-def standard_error(values):
-    """Standard error of the given list of values, treating None values as not
-    existing"""
-    return (numpy.std([v for v in values if v is not None], ddof=1) /
-            numpy.sqrt(len(values)))
-
-
-@total_ordering             # Only have to implement __lt__ and __eq__ for cmp
-class Otu:
-    def __init__(self, values, name, min_abundance, i_indexes):
-        """Construct from a list of ordered values, otu name, minimum abundance
-        to be present, and list of indexes of the interest group"""
-        # Store the inputs
-        self.name = name
-        self.i_indexes = i_indexes
-        self.min_abundance = min_abundance
-        self.values = values
-
-        interest_values = interest(values, i_indexes)
-        out_values = out(values, i_indexes)
-        self.interest_present = count(present(interest_values, min_abundance))
-        self.interest_absent = count(absent(interest_values, min_abundance))
-        self.interest_mean = mean(interest_values)
-        self.interest_error = standard_error(interest_values)
-        self.out_present = count(present(out_values, min_abundance))
-        self.out_absent = count(absent(out_values, min_abundance))
-        self.out_mean = mean(out_values)
-        self.out_error = standard_error(out_values)
-
-        self.interest = self.interest_present + self.interest_absent
-        self.out = self.out_present + self.out_absent
-        self.present = self.interest_present + self.out_present
-        self.absent = self.interest_absent + self.out_absent
-        self.total = self.interest + self.out
-
-        self.interest_frac = self.interest_present / float(self.interest)
-        self.out_frac = self.out_present / float(self.out)
-
-    def __lt__(self, other):
-        """Comparison for sorting. Greatest interest presence frac is smallest,
-        with ties broken first by least p-value and finally by first
-        (alphabetically) OTU name. Corrected_pval must have been calculated
-        first"""
-        return (self.interest_frac > other.interest_frac or
-                self.corrected_pval < other.corrected_pval or
-                self.name < other.name)
-
-    def __eq__(self, other):
-        """Equality for sorting. Equal if equal interest presence frac,
-        corrected_pval, and OTU name (should never happen in use)
-        Corrected_pval must have been calculated first"""
-        return (self.interest_frac == other.interest_frac and
-                self.corrected_pval == other.corrected_pval and
-                self.name == other.name)
+
+# Type of the arrays holding counts of samples
+COUNT_TYPE = numpy.int32
+
+
+def presence_counts(values, thresholds):
+    """Count the values in each row of the two dimensional array values that
+    are greater than each of the given thresholds. Each value is binned by
+    how many of the thresholds it is above, so a single pass over values gives
+    every row's histogram over the thresholds, from which the counts for all
+    of them follow. Returns an array with a row for each row of values and a
+    column for each threshold"""
+    thresholds = numpy.asarray(thresholds, dtype=float)
+    order = numpy.argsort(thresholds)
+    n_bins = len(thresholds) + 1
+    # Number of the (sorted) thresholds each value is greater than
+    bins = numpy.searchsorted(thresholds[order], values, side='left')
+    bins += numpy.arange(len(values))[:, numpy.newaxis] * n_bins
+    hist = numpy.bincount(bins.ravel(), minlength=len(values) * n_bins)
+    hist = hist.reshape((len(values), n_bins))
+    # The values greater than the j-th threshold are in the bins after j
+    above = hist[:, ::-1].cumsum(axis=1)[:, ::-1][:, 1:]
+    counts = numpy.zeros((len(values), len(thresholds)), dtype=COUNT_TYPE)
+    counts[:, order] = above
+    return counts
+
+
+def group_stats(values, thresholds, n_samples):
+    """Calculate the presence counts for each of the given min_abundance
+    thresholds, means, and standard errors of every row of the given two
+    dimensional array of values at once. The standard error is scaled by
+    n_samples, the number of samples in the whole table"""
+    present = presence_counts(values, thresholds)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = values.mean(axis=1)
+        error = values.std(axis=1, ddof=1) / numpy.sqrt(n_samples)
+    return present, mean, error
+
+
+def otu_stats(values, i_mask, min_abundance):
+    """Calculate the statistics for every OTU (row) of the OTU by sample
+    matrix values in a few vectorized passes. i_mask is a boolean array that is
+    True for the columns of the interest group. Returns a dictionary from Otu
+    attribute names to arrays holding that attribute for every OTU"""
+    return abundance_sweep_stats(values, i_mask, [min_abundance])[0]
+
+
+def abundance_sweep_stats(values, i_mask, thresholds):
+    """Calculate the statistics for every OTU as otu_stats does, for each of
+    the given min_abundance thresholds. Only the presence counts depend on the
+    threshold, and those for every threshold are counted in the same pass.
+    Returns a list of dictionaries of statistics, one for each threshold"""
+    n_samples = values.shape[1]
+    n_interest = COUNT_TYPE(i_mask.sum())
+    i_present, i_mean, i_error = group_stats(values[:, i_mask], thresholds,
+                                             n_samples)
+    o_present, o_mean, o_error = group_stats(values[:, ~i_mask], thresholds,
+                                             n_samples)
+    n_out = COUNT_TYPE(n_samples - n_interest)
+    sweep = list()
+    for i in xrange(len(thresholds)):
+        stats = {'interest_present': i_present[:, i],
+                 'interest_mean': i_mean, 'interest_error': i_error,
+                 'out_present': o_present[:, i],
+                 'out_mean': o_mean, 'out_error': o_error}
+        sweep.append(count_stats(stats, n_interest, n_out))
+    return sweep
+
+
+def one_vs_rest_stats(values, groups, thresholds):
+    """Calculate the statistics for every OTU as otu_stats does, taking each
+    group in turn as the interest group and the rest of the samples as the
+    out group, for each of the given min_abundance thresholds. groups is a
+    boolean matrix with a row for each sample and a column for each group
+    that is True where the sample is in the group. Returns a list with a list
+    of dictionaries of statistics for each group, one for each threshold"""
+    n_samples = values.shape[1]
+    n_interest, sums, squares, present = group_sums(values, groups,
+                                                    thresholds)
+    n_out = n_samples - n_interest
+    i_mean, i_error = moments(sums, squares, n_interest, n_samples)
+    o_mean, o_error = moments(values.sum(axis=1)[:, numpy.newaxis] - sums,
+                              (values * values).sum(axis=1)[:, numpy.newaxis] -
+                              squares, n_out, n_samples)
+    all_present = [(values > threshold).sum(axis=1).astype(COUNT_TYPE)
+                   for threshold in thresholds]
+
+    groups_stats = list()
+    for g in xrange(groups.shape[1]):
+        sweep = list()
+        for i_present, o_present in zip(present, all_present):
+            stats = {'interest_present': i_present[:, g],
+                     'interest_mean': i_mean[:, g],
+                     'interest_error': i_error[:, g],
+                     'out_present': o_present - i_present[:, g],
+                     'out_mean': o_mean[:, g], 'out_error': o_error[:, g]}
+            sweep.append(count_stats(stats, n_interest[g], n_out[g]))
+        groups_stats.append(sweep)
+    return groups_stats
+
+
+def contrast_stats(totals, pairs):
+    """Calculate the statistics for every OTU as otu_stats does for each of
+    the given pairs of group indexes (a, b), taking group a as the interest
+    group and group b as the out group and ignoring the other samples, for
+    each threshold. totals are the sums over each group returned by
+    group_sums. Returns a list with a list of dictionaries of statistics for
+    each pair, one for each threshold"""
+    n, sums, squares, present = totals
+    pairs_stats = list()
+    for a, b in pairs:
+        # The standard error is scaled by the number of samples in the pair,
+        # as it would be for a table of just those samples
+        n_samples = n[a] + n[b]
+        i_mean, i_error = moments(sums[:, a], squares[:, a], n[a], n_samples)
+        o_mean, o_error = moments(sums[:, b], squares[:, b], n[b], n_samples)
+        sweep = list()
+        for counts in present:
+            stats = {'interest_present': counts[:, a],
+                     'interest_mean': i_mean, 'interest_error': i_error,
+                     'out_present': counts[:, b],
+                     'out_mean': o_mean, 'out_error': o_error}
+            sweep.append(count_stats(stats, n[a], n[b]))
+        pairs_stats.append(sweep)
+    return pairs_stats
+
+
+def group_sums(values, groups, thresholds):
+    """Sum over the samples of each group, given as for one_vs_rest_stats, of
+    the values, their squares, and their presences for each of the given
+    thresholds, all as products with groups. Returns the number of samples in
+    each group, the sums and sums of squares as matrices with a column for
+    each group, and a list of presence count matrices, one for each
+    threshold"""
+    indicator = groups.astype(float)
+    n = groups.sum(axis=0).astype(COUNT_TYPE)
+    sums = values.dot(indicator)
+    squares = (values * values).dot(indicator)
+    present = [(values > threshold).astype(float).dot(
+        indicator).astype(COUNT_TYPE) for threshold in thresholds]
+    return n, sums, squares, present
+
+
+def mirror_stats(stats):
+    """The statistics of the OTUs with the interest and out groups swapped"""
+    mirrored = dict()
+    for attr, column in stats.iteritems():
+        if attr.startswith('interest'):
+            attr = 'out' + attr[len('interest'):]
+        elif attr.startswith('out'):
+            attr = 'interest' + attr[len('out'):]
+        mirrored[attr] = column
+    return mirrored
+
+
+def moments(sums, squares, n, n_samples):
+    """The means and standard errors, scaled by n_samples as in group_stats,
+    of groups of n values with the given sums and sums of squares"""
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / n
+        variance = numpy.maximum(squares - sums * mean, 0) / (n - 1)
+        error = numpy.sqrt(variance) / numpy.sqrt(n_samples)
+    return mean, error
+
+
+def count_stats(stats, n_interest, n_out):
+    """Fill in the statistics that follow from the interest and out group
+    presence counts in stats and the sizes of the groups. Returns stats"""
+    stats['interest_absent'] = n_interest - stats['interest_present']
+    stats['out_absent'] = n_out - stats['out_present']
+
+    stats['interest'] = stats['interest_present'] + stats['interest_absent']
+    stats['out'] = stats['out_present'] + stats['out_absent']
+    stats['present'] = stats['interest_present'] + stats['out_present']
+    stats['absent'] = stats['interest_absent'] + stats['out_absent']
+    stats['total'] = stats['interest'] + stats['out']
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        stats['interest_frac'] = (stats['interest_present'] /
+                                  stats['interest'].astype(float))
+        stats['out_frac'] = stats['out_present'] / stats['out'].astype(float)
+    return stats
+
+
+class OtuTable(object):
+    """Statistics of a set of OTUs, stored as one array per attribute with an
+    entry for each OTU. The arrays can be accessed as attributes of the table,
+    and indexing or iterating over the table gives Otu views of single OTUs"""
+    def __init__(self, names, columns):
+        """Construct from a list of OTU names and a dictionary from attribute
+        names to arrays in the same order as names"""
+        self.names = numpy.asarray(names, dtype=object)
+        self.columns = columns
+
+    def filter(self, mask):
+        """A new OtuTable holding only the OTUs selected by the given boolean
+        or index array"""
+        return OtuTable(self.names[mask],
+                        dict((attr, column[mask])
+                             for attr, column in self.columns.iteritems()))
+
+    def sorted(self, top=None):
+        """A new OtuTable with the OTUs ordered by decreasing interest
+        presence frac, with ties broken first by least corrected p-value and
+        finally by first (alphabetically) OTU name. If top is given only that
+        many OTUs from the start of that order are kept"""
+        name_rank = numpy.zeros(len(self), dtype=int)
+        name_rank[numpy.argsort(self.names)] = numpy.arange(len(self))
+        order = numpy.lexsort((name_rank, self.corrected_pval,
+                               -self.interest_frac))
+        return self.filter(order[:top])
+
+    def __getattr__(self, attr):
+        try:
+            return self.__dict__['columns'][attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, row):
+        if not -len(self) <= row < len(self):
+            raise IndexError(row)
+        return Otu(self, row % len(self))
+
+    def __iter__(self):
+        for row in xrange(len(self)):
+            yield Otu(self, row)
+
+
+class Otu(object):
+    """View of a single OTU of an OtuTable. The values of the table's arrays
+    for this OTU are its attributes"""
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def name(self):
+        return self.table.names[self.row]
+
+    def __getattr__(self, attr):
+        try:
+            return self.table.columns[attr][self.row].item()
+        except KeyError:
+            raise AttributeError(attr)
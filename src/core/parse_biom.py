@@ -0,0 +1,304 @@
+# Copyright 2016, 2017 Richard Rodrigues, Nyle Rodgers, Mark Williams,
+# Virginia Tech
+#
+# This file is part of Coremic.
+#
+# Coremic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Coremic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Coremic. If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import re
+from StringIO import StringIO
+from collections import namedtuple
+import numpy
+
+# h5py is only needed for BIOM 2.x (HDF5) files, and isn't available on App
+# Engine
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# Number of bytes read from a JSON BIOM file at a time
+CHUNK_SIZE = 1 << 20
+# Number of nonzero entries read from an HDF5 BIOM file at a time
+HDF5_CHUNK_SIZE = 1 << 20
+
+HDF5_SIGNATURE = '\x89HDF\r\n\x1a\n'
+
+# The contents of a BIOM file. The table is given by the row, column, and
+# value arrays of its nonzero entries. sample_totals holds the sum of each
+# sample over every observation
+BiomData = namedtuple('BiomData', ['sample_ids', 'observation_ids',
+                                   'observation_metadata', 'shape',
+                                   'rows', 'columns', 'values',
+                                   'sample_totals'])
+
+WHITESPACE = ' \t\r\n'
+# End of an array of arrays, I.E. the end of its last inner array followed by
+# the end of the outer array
+END_OF_LISTS = re.compile(r'\]\s*\]')
+
+
+def parse_biom(table_file, sample_ids=None):
+    """Parse a BIOM file, given as a string or an open file, without holding
+    more than its nonzero values and ids in memory. Both JSON (BIOM 1.0) and
+    HDF5 (BIOM 2.x) files are accepted. If a set of sample_ids is given only
+    those samples are kept"""
+    if isinstance(table_file, unicode):
+        table_file = table_file.encode('utf-8')
+    if isinstance(table_file, str):
+        table_file = StringIO(table_file)
+    if table_file.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE:
+        table_file.seek(0)
+        biom = parse_hdf5_biom(table_file, sample_ids)
+    else:
+        table_file.seek(0)
+        biom = parse_json_biom(table_file)
+    if biom.sample_totals is None:
+        biom = select_samples(biom, sample_ids)
+    return biom
+
+
+def check_biom(table_file, allow_hdf5=True):
+    """Raise a ValueError if the given open file does not start as a JSON or
+    HDF5 BIOM file would, or as an HDF5 file if allow_hdf5 is not set. Only
+    its first few bytes are read, and the file is returned to its start"""
+    start = table_file.read(len(HDF5_SIGNATURE))
+    table_file.seek(0)
+    if not start:
+        raise ValueError('Empty BIOM file')
+    if start == HDF5_SIGNATURE and not allow_hdf5:
+        raise ValueError('HDF5 (BIOM 2.x) files are not supported here, '
+                         'convert to JSON (BIOM 1.0) first')
+    # A JSON file may start with more whitespace than was read
+    json_start = start.lstrip(WHITESPACE)
+    if start != HDF5_SIGNATURE and json_start and json_start[0] != '{':
+        raise ValueError('Not a BIOM file')
+
+
+def select_samples(biom, sample_ids):
+    """Drop the samples not in sample_ids, or none if it is None, from the
+    given BiomData, filling in the totals of the remaining samples"""
+    totals = numpy.bincount(biom.columns, weights=biom.values,
+                            minlength=len(biom.sample_ids))
+    if sample_ids is None:
+        return biom._replace(sample_totals=totals)
+    kept = numpy.array([id in sample_ids for id in biom.sample_ids],
+                       dtype=bool)
+    new_columns = numpy.cumsum(kept) - 1
+    entries = kept[biom.columns]
+    return biom._replace(
+        sample_ids=[id for id, keep in zip(biom.sample_ids, kept) if keep],
+        shape=(biom.shape[0], kept.sum()),
+        rows=biom.rows[entries],
+        columns=new_columns[biom.columns[entries]],
+        values=biom.values[entries],
+        sample_totals=totals[kept])
+
+
+def parse_json_biom(table_file, chunk_size=CHUNK_SIZE):
+    """Parse a JSON BIOM file incrementally, reading chunk_size bytes at a
+    time. Only the data matrix can be large enough for this to matter, so it
+    is read a chunk at a time straight in to arrays, while everything else is
+    decoded as usual"""
+    stream = JsonStream(table_file, chunk_size)
+    fields = dict()
+    stream.expect('{')
+    while stream.next_char() != '}':
+        key = stream.decode()
+        stream.expect(':')
+        if key == 'data':
+            fields['data'] = stream.read_number_lists()
+        else:
+            fields[key] = stream.decode()
+        if stream.next_char() == ',':
+            stream.expect(',')
+    for field in ('rows', 'columns', 'shape', 'matrix_type', 'data'):
+        if field not in fields:
+            raise ValueError('BIOM file has no "%s" field' % field)
+
+    numbers, n_lists = fields['data']
+    shape = tuple(fields['shape'])
+    if fields['matrix_type'] == 'sparse':
+        triplets = numbers.reshape((n_lists, 3))
+        rows = triplets[:, 0].astype(int)
+        columns = triplets[:, 1].astype(int)
+        values = triplets[:, 2].copy()
+    elif fields['matrix_type'] == 'dense':
+        matrix = numbers.reshape(shape)
+        rows, columns = matrix.nonzero()
+        values = matrix[rows, columns]
+    else:
+        raise ValueError('Unknown matrix type "%s"' % fields['matrix_type'])
+    return BiomData([column['id'] for column in fields['columns']],
+                    [row['id'] for row in fields['rows']],
+                    [row.get('metadata') or dict() for row in fields['rows']],
+                    shape, rows, columns, values, None)
+
+
+def parse_hdf5_biom(table_file, sample_ids=None):
+    """Parse a HDF5 (BIOM 2.x) file. The compressed sparse matrix is read from
+    its datasets a chunk at a time. If a set of sample_ids is given only the
+    data of those samples is read, from the sample-major matrix"""
+    if h5py is None:
+        raise ValueError('HDF5 BIOM files can not be read without h5py')
+    with h5py.File(table_file, 'r') as f:
+        all_sample_ids = [to_unicode(id) for id in f['sample/ids'][:]]
+        observation_ids = [to_unicode(id) for id in f['observation/ids'][:]]
+
+        if 'observation/metadata/taxonomy' not in f:
+            raise ValueError('BIOM file has no observation taxonomy')
+        # Read in one go, since each access of the dataset is slow
+        taxonomy = f['observation/metadata/taxonomy'][:]
+        observation_metadata = [
+            {'taxonomy': [to_unicode(level) for level in levels]}
+            for levels in taxonomy]
+
+        if sample_ids is None:
+            sample_ids = all_sample_ids
+            indptr, columns, values = read_compressed(f['observation/matrix'])
+            rows = numpy.repeat(numpy.arange(len(observation_ids)),
+                                numpy.diff(indptr))
+            sample_totals = None
+        else:
+            kept = [i for i, id in enumerate(all_sample_ids)
+                    if id in sample_ids]
+            sample_ids = [all_sample_ids[i] for i in kept]
+            indptr, rows, values = read_compressed(f['sample/matrix'], kept)
+            columns = numpy.repeat(numpy.arange(len(kept)), numpy.diff(indptr))
+            sample_totals = numpy.bincount(columns, weights=values,
+                                           minlength=len(kept))
+    return BiomData(sample_ids, observation_ids, observation_metadata,
+                    (len(observation_ids), len(sample_ids)),
+                    rows, columns, values, sample_totals)
+
+
+def read_compressed(matrix, major=None):
+    """Read the indptr, indices, and data arrays of the given HDF5 compressed
+    sparse matrix group. If a list of major axis indexes is given only they are
+    read, and the returned indptr is for just those"""
+    full_indptr = matrix['indptr'][:]
+    if major is None:
+        # The whole matrix is one contiguous run
+        indptr = full_indptr - full_indptr[0]
+        runs = [(full_indptr[0], full_indptr[-1], 0)]
+    else:
+        major = numpy.asarray(major, dtype=int)
+        starts, ends = full_indptr[major], full_indptr[major + 1]
+        indptr = numpy.append(0, numpy.cumsum(ends - starts))
+        runs = zip(starts, ends, indptr)
+    indices = numpy.zeros(indptr[-1], dtype=int)
+    data = numpy.zeros(indptr[-1])
+    for start, end, to in runs:
+        for chunk in xrange(start, end, HDF5_CHUNK_SIZE):
+            chunk_end = min(chunk + HDF5_CHUNK_SIZE, end)
+            to_chunk = to + chunk - start
+            to_end = to_chunk + chunk_end - chunk
+            indices[to_chunk:to_end] = matrix['indices'][chunk:chunk_end]
+            data[to_chunk:to_end] = matrix['data'][chunk:chunk_end]
+    return indptr, indices, data
+
+
+def to_unicode(value):
+    """HDF5 string datasets may hold bytes or unicode"""
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class JsonStream(object):
+    """Reads JSON values from a file a chunk at a time"""
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        """Read more of the file in to the buffer. Returns False if the end of
+        the file has already been reached"""
+        if self.eof:
+            return False
+        # Read at least as much as is already buffered so that values that
+        # span many chunks are only re-decoded a logarithmic number of times
+        chunk = self.f.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+        return not self.eof
+
+    def next_char(self):
+        """The next non-whitespace character, which is not consumed"""
+        while True:
+            while (self.pos < len(self.buffer) and
+                   self.buffer[self.pos] in WHITESPACE):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of BIOM file')
+
+    def expect(self, char):
+        if self.next_char() != char:
+            raise ValueError('Malformed BIOM file: expected "%s" but found '
+                             '"%s"' % (char, self.buffer[self.pos]))
+        self.pos += 1
+
+    def decode(self):
+        """Decode the next JSON value"""
+        self.next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer may continue in the file
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise ValueError('Malformed BIOM file')
+            self.fill()
+
+    def read_number_lists(self):
+        """Read a JSON array of arrays of numbers. Returns all the numbers in
+        a single flat array, along with the number of inner arrays"""
+        self.expect('[')
+        parts = list()
+        n_lists = 0
+        while True:
+            if self.next_char() == ']':   # End of the outer array
+                self.pos += 1
+                break
+            end = END_OF_LISTS.search(self.buffer, self.pos)
+            if end is not None:
+                text = self.buffer[self.pos:end.start() + 1]
+                self.pos = end.end()
+            else:
+                # Only take whole inner arrays
+                cut = self.buffer.rfind(']', self.pos) + 1
+                text = self.buffer[self.pos:cut] if cut else ''
+                self.pos = max(self.pos, cut)
+            text = text.lstrip(WHITESPACE + ',')
+            if text:
+                n_lists += text.count(']')
+                parts.append(numpy.fromstring(
+                    text.replace('[', ' ').replace(']', ' '), sep=','))
+            if end is not None:
+                break
+            if not self.fill():
+                raise ValueError('Unexpected end of BIOM file')
+        if not parts:
+            return numpy.zeros(0), 0
+        return numpy.concatenate(parts), n_lists
@@ -17,98 +17,159 @@
 # along with Coremic. If not, see <http://www.gnu.org/licenses/>.
 
 
-from biom.parse import parse_biom_table
-from biom.table import table_factory, SparseOTUTable
-from numpy import array, append
-from itertools import groupby
+import logging
+from numpy import (array, asarray, empty, zeros, ones, arange, newaxis,
+                   where, maximum, minimum, concatenate, lexsort, flatnonzero,
+                   add)
+
+from parse_biom import parse_biom
+from table import Table
+from table_cache import table_key
 
 # groupfile delimitere
 DELIM = '\t'
 
 
-def read_table(table_file, normalize=False, do_quantile_normalize=False):
-    """Read in the input datafile and combine any doubled OTUs
+def read_table(table_file, normalize=False, do_quantile_normalize=False,
+               quantile_ties='first', sample_ids=None):
+    """Read in the input datafile, given as a string or an open file, and
+    combine any doubled OTUs. If a set of sample_ids is given only those
+    samples are read
     """
-    parsed_table = parse_biom_table(table_file)
-    sample_ids = parsed_table.SampleIds
-    otu_data = dict()
-    for vals, id, md in parsed_table.iterObservations():
+    biom = parse_biom(table_file, sample_ids)
+    sample_ids = biom.sample_ids
+    # The row of the combined table each observation is summed in to
+    otu_rows = dict()
+    groups = empty(len(biom.observation_ids), dtype=int)
+    for i, md in enumerate(biom.observation_metadata):
+        if 'taxonomy' not in md:
+            raise ValueError('Observation %s has no taxonomy' %
+                             biom.observation_ids[i])
         otu = md['taxonomy']
         if(isinstance(otu, type(list()))):
             otu = ';'.join(otu)
-        if otu_data.get(otu) is not None:
-            otu_data[otu] = vals + otu_data[otu]  # both are numpy arrays
-        else:
-            otu_data[otu] = vals
+        groups[i] = otu_rows.setdefault(otu, len(otu_rows))
+    observation_ids = sorted(otu_rows, key=otu_rows.get)
 
-    observation_ids = otu_data.keys()
-    data = [otu_data[o] for o in observation_ids]
+    rows, columns, values = sum_triplets(groups[biom.rows], biom.columns,
+                                         biom.values)
+    shape = (len(observation_ids), len(sample_ids))
     if normalize:
-        data = normalize_columns(data)
+        empty_samples = [id for id, empty_sample
+                         in zip(sample_ids,
+                                normalize_columns(columns, values,
+                                                  biom.sample_totals))
+                         if empty_sample]
+        if empty_samples:
+            logging.warning('Samples with no observations left as zeros ' +
+                            'when converting to relative abundance: %s',
+                            ', '.join(empty_samples))
     if do_quantile_normalize:
-        data = quantile_normalize(data)
-    return table_factory(data, sample_ids, observation_ids,
-                         constructor=SparseOTUTable)
+        data = zeros(shape)
+        data[rows, columns] = values
+        return Table.from_dense(quantile_normalize(data, quantile_ties,
+                                                   in_place=True),
+                                sample_ids, observation_ids)
+    return Table.from_triplets(rows, columns, values, sample_ids,
+                               observation_ids)
+
+
+def sum_triplets(rows, columns, values):
+    """Sums the values of entries of a sparse table, given as arrays of the
+    row, column, and value of each entry, that are in the same row and column.
+    Returns new arrays sorted by row and then column"""
+    if not len(values):
+        return rows, columns, values
+    order = lexsort((columns, rows))
+    rows, columns = rows[order], columns[order]
+    starts = ones(len(order), dtype=bool)
+    starts[1:] = (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1])
+    starts = flatnonzero(starts)
+    return rows[starts], columns[starts], add.reduceat(values[order], starts)
 
 
 def combine_tables(tables):
-    """Combines multiple biom tables into a signle table, discarding any
-    non-shared OTUs.
+    """Combines multiple tables into a signle table, discarding any
+    non-shared OTUs. Samples found more than once are taken from their first
+    occurrence.
     """
-    samples = [sample for sample_list in [table.SampleIds for table in tables]
-               for sample in sample_list]
-    duplicate_sample_indices = [
-        index for indices in [[index for index, value in indices][1:]
-                              for sample, indices
-                              in groupby(sorted(enumerate(samples),
-                                                key=lambda x: x[1]),
-                                         lambda x: x[1])]
-        for index in indices]
-    otu_data = dict()
-    for table in tables:
-        for vals, otu, md in table.iterObservations():
-            if otu_data.get(otu) is not None:
-                otu_data[otu] = append(otu_data[otu], vals)
-            else:
-                otu_data[otu] = vals
-    otus = [otu for otu in otu_data if len(otu_data[otu]) == len(samples)]
+    shared = set(tables[0].observation_ids)
+    for table in tables[1:]:
+        shared.intersection_update(table.observation_ids)
+    otus = [otu for otu in tables[0].observation_ids if otu in shared]
     if not otus:
         raise ValueError('No shared OTUs')
-    data = [array([v for i, v in enumerate(otu_data[otu])
-                   if i not in duplicate_sample_indices]) for otu in otus]
-    samples = [v for i, v in enumerate(samples)
-               if i not in duplicate_sample_indices]
-
-    return table_factory(data, samples, otus, constructor=SparseOTUTable)
-
-
-def normalize_columns(data):
-    """Adjust the given two dimensional array so that the sum of the values in
-    each column in one"""
-    for i in range(len(data[0])):
-        total = sum([row[i] for row in data])
-        for row in data:
-            row[i] = row[i] / float(total)
-    return data
-
-
-def quantile_normalize(data):
-    """Quantile normalize the data"""
-    columns = [[row[i] for row in data] for i in range(len(data[0]))]
-    sorted_columns = [sorted(column) for column in columns]
-    distribution = [(sum([column[i] for column in sorted_columns]) /
-                     len(sorted_columns))
-                    for i in range(len(sorted_columns[0]))]
-    result = [
-        [newval for newval, column_i
-         in sorted([(distribution[dist_i], column_i)
-                    for dist_i, (column_i, val)
-                    in enumerate(sorted(enumerate(column),
-                                        key=lambda x: x[1]))],
-                   key=lambda x: x[1])]
-        for column in columns]
-    return [array([column[i] for column in result])
-            for i in range(len(result[0]))]
+    otu_rows = dict((otu, row) for row, otu in enumerate(otus))
+
+    samples = list()
+    sample_columns = dict()
+    rows, columns, values = list(), list(), list()
+    for table in tables:
+        # The row and column of the combined table each row and column of
+        # this table goes to, or -1 if it isn't used
+        to_rows = array([otu_rows.get(otu, -1)
+                         for otu in table.observation_ids], dtype=int)
+        to_columns = -ones(len(table.sample_ids), dtype=int)
+        for column, sample in enumerate(table.sample_ids):
+            if sample not in sample_columns:
+                sample_columns[sample] = len(samples)
+                samples.append(sample)
+                to_columns[column] = sample_columns[sample]
+        table_rows, table_columns, table_values = table.triplets()
+        table_rows = to_rows[table_rows]
+        table_columns = to_columns[table_columns]
+        used = (table_rows >= 0) & (table_columns >= 0)
+        rows.append(table_rows[used])
+        columns.append(table_columns[used])
+        values.append(table_values[used])
+
+    return Table.from_triplets(concatenate(rows), concatenate(columns),
+                               concatenate(values), samples, otus)
+
+
+def normalize_columns(columns, values, totals):
+    """Adjust the values of a sparse table, given as arrays of the column and
+    value of each nonzero entry, in place so that the sum of the values in
+    each column in one, given the current totals of the columns. Returns a
+    boolean array that is True for the columns that have no values, which are
+    left as zeros"""
+    values /= totals[columns]
+    return totals == 0
+
+
+def quantile_normalize(data, ties='first', in_place=False):
+    """Quantile normalize the columns of the given two dimensional array. Tied
+    values are either given the distribution values of their ranks in row
+    order (ties='first') or all given the average of the distribution values
+    over their ranks (ties='average'). The array is overwritten if in_place
+    is set"""
+    data = asarray(data, dtype=float)
+    rows, columns = data.shape
+    column_indices = arange(columns)
+    order = data.argsort(axis=0, kind='mergesort')
+    sorted_data = data[order, column_indices]
+    distribution = sorted_data.mean(axis=1)
+    if ties == 'average':
+        ranks = arange(rows)[:, newaxis]
+        run_starts = ones(data.shape, dtype=bool)
+        run_starts[1:] = sorted_data[1:] != sorted_data[:-1]
+        run_ends = ones(data.shape, dtype=bool)
+        run_ends[:-1] = run_starts[1:]
+        first = maximum.accumulate(where(run_starts, ranks, 0), axis=0)
+        last = minimum.accumulate(where(run_ends, ranks, rows)[::-1],
+                                  axis=0)[::-1]
+        totals = concatenate(([0.0], distribution.cumsum()))
+        values = (totals[last + 1] - totals[first]) / (last - first + 1)
+    else:
+        values = distribution[:, newaxis]
+    result = data if in_place else empty(data.shape)
+    result[order, column_indices] = values
+    return result
+
+
+def as_list(value):
+    """value if it is a list, otherwise a list of just value"""
+    return value if isinstance(value, list) else [value]
 
 
 def parse_groupfile(groupfile, factor):
@@ -139,9 +200,41 @@ def parse_groupfile(groupfile, factor):
     return local_dict
 
 
-def parse_inputs(params, groupfile, datafiles):
+def read_tables(params, datafiles, sample_ids=None, table_cache=None):
+    """Read the given datafiles and combine them into a single table. If a
+    TableCache is given the table is taken from it when the same datafiles
+    have already been read with the same options, and added to it otherwise"""
+    if table_cache is not None:
+        key = table_key(datafiles, {
+            'make_relative': params['make_relative'],
+            'quantile_normalize': params['quantile_normalize'],
+            'quantile_ties': params['quantile_ties'],
+            'sample_ids': sorted(sample_ids) if sample_ids else None,
+        })
+        table = table_cache.get(key)
+        if table is not None:
+            return table
+    table = combine_tables([read_table(datafile, params['make_relative'],
+                                       params['quantile_normalize'],
+                                       params['quantile_ties'], sample_ids)
+                            for datafile in datafiles])
+    if table_cache is not None:
+        table_cache.put(key, table)
+    return table
+
+
+def parse_inputs(params, groupfile, datafiles, table_cache=None):
     """Validate that the given inputs are usable and parse them into usable
-    formats"""
+    formats. Parsed tables are cached in table_cache if one is given"""
+    errors_list, mapping_dict, out_group = validate_inputs(params, groupfile)
+    read_errors, filtered_data = read_inputs(params, mapping_dict, datafiles,
+                                             table_cache)
+    return (errors_list + read_errors, mapping_dict, out_group, filtered_data)
+
+
+def validate_inputs(params, groupfile):
+    """Validate the groupfile and parameters, without reading the datafiles.
+    This is quick enough to do while handling a request"""
 
     errors_list = list()
 
@@ -159,23 +252,29 @@ def parse_inputs(params, groupfile, datafiles):
         mapping_dict = dict()
         out_group = None
 
-    try:
-        filtered_data = combine_tables(map(
-            lambda table: read_table(table, params['make_relative'],
-                                     params['quantile_normalize']),
-            datafiles))
-    except ValueError as e:
-        errors_list.append('Datafile could not be read: %s' % e.message)
-        filtered_data = None
-
-    if params['max_p'] < 0 or params['max_p'] > 1:
+    # Thresholds may be lists of values to sweep over
+    if min(as_list(params['max_p'])) < 0 or max(as_list(params['max_p'])) > 1:
         errors_list.append('Maximum p-value must be in the range zero to one')
-    if params['min_frac'] < 0 or params['min_frac'] > 1:
+    if (min(as_list(params['min_frac'])) < 0 or
+            max(as_list(params['min_frac'])) > 1):
         errors_list.append('Minimum interest group presence must be in range' +
                            ' zero to one')
-    if params['max_out_presence'] < 0 or params['max_out_presence'] > 1:
+    if (min(as_list(params['max_out_presence'])) < 0 or
+            max(as_list(params['max_out_presence'])) > 1):
         errors_list.append('Maximum out-group presence must be in range' +
                            ' zero to one')
     # Should verify p-value-adjust is valid value
 
-    return (errors_list, mapping_dict, out_group, filtered_data)
+    return (errors_list, mapping_dict, out_group)
+
+
+def read_inputs(params, mapping_dict, datafiles, table_cache=None):
+    """Read the datafiles into a single table, keeping only the samples in
+    mapping_dict. Returns a list of errors and the table"""
+    # Only the samples in the groupfile are used, so only they are read
+    sample_ids = (set([id for ids in mapping_dict.values() for id in ids])
+                  if mapping_dict else None)
+    try:
+        return [], read_tables(params, datafiles, sample_ids, table_cache)
+    except ValueError as e:
+        return ['Datafile could not be read: %s' % e.message], None
@@ -15,31 +15,305 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Coremic. If not, see <http://www.gnu.org/licenses/>.
-from pval import getpval, correct_pvalues
-from otu import Otu
-
-
-def process(inputs, cfg):
-    """Finds the core OTUs"""
-    interest_ids = [otu for g in cfg['group']
-                    for otu in inputs['mapping_dict'][g]]
-    i_indexes = [i for i, id in enumerate(inputs['filtered_data'].SampleIds)
-                 if id in interest_ids]
-    otus = [Otu(vals, name, cfg['min_abundance'], i_indexes)
-            for vals, name, md in inputs['filtered_data'].iterObservations()]
-    pvals = list()
-    for otu in otus:
-        pval = getpval(otu)
-        otu.pval = pval
-        pvals.append(pval)
-    for otu, corrected_pval in zip(otus,
-                                   correct_pvalues(pvals, cfg['p_val_adj'])):
-        otu.corrected_pval = corrected_pval
-    # Filter down to the core
-    return [otu for otu in otus
-            if (otu.corrected_pval <= cfg['max_p'] and
-                otu.interest_frac >= cfg['min_frac'] and
-                otu.out_frac <= cfg['max_out_presence'])]
+import numpy
+from StringIO import StringIO
+
+from pval import getpvals, correct_pvalues
+from otu import (OtuTable, otu_stats, abundance_sweep_stats,
+                 one_vs_rest_stats, contrast_stats, group_sums,
+                 mirror_stats)
+from parse_inputs import as_list
+
+# Approximate size of the dense blocks of the table processed at a time
+CHUNK_BYTES = 1 << 24
+# Approximate number of columns of an OtuTable with p-values
+STATS_COLUMNS = 17
+
+
+def process(inputs, cfg, symmetric=False, chunk_bytes=CHUNK_BYTES):
+    """Finds the core OTUs. If symmetric is set the core of the out group,
+    taking all the samples not in the interest group as the out group's
+    interest group and vice versa, is found as well and both cores are
+    returned. The out group's statistics mirror the interest group's, so both
+    come from one set of counts and their p-values are calculated together.
+
+    The table is processed a block of OTUs at a time, each taking about
+    chunk_bytes as a dense matrix. Only the p-values of every OTU, which the
+    multiple testing correction needs, and the statistics of the OTUs that
+    pass the presence thresholds are kept from each block"""
+    shards = [process_shard(inputs, cfg, start, end, symmetric)
+              for start, end in shard_ranges(inputs['filtered_data'].shape,
+                                             chunk_bytes // 8)]
+    cores = [gather_shards([shard[side] for shard in shards], cfg)
+             for side in xrange(len(shards[0]))]
+    return tuple(cores) if symmetric else cores[0]
+
+
+def shard_ranges(shape, max_cells):
+    """Split the rows of a table of the given shape in to contiguous ranges
+    of about max_cells entries each. Returns a list of (start, end) pairs, of
+    which there is always at least one"""
+    n_rows, n_columns = shape
+    rows = max(1, max_cells // max(1, n_columns))
+    return [(start, min(start + rows, n_rows))
+            for start in xrange(0, max(1, n_rows), rows)]
+
+
+def process_shard(inputs, cfg, start, end, symmetric=False):
+    """The part of process for the OTUs in rows start up to end of the table.
+    Returns a list with a pair for the interest group, and for the out group
+    as well if symmetric is set, of the p-values of the OTUs and an OtuTable
+    of only the OTUs that pass the presence thresholds, with their rows in
+    the table as its index attribute"""
+    table = inputs['filtered_data']
+    names = numpy.asarray(table.observation_ids[start:end], dtype=object)
+    i_mask = interest_mask(inputs['mapping_dict'], cfg['group'],
+                           table.sample_ids)
+    columns = otu_stats(table.dense(start, end), i_mask, cfg['min_abundance'])
+    sides = [columns, mirror_stats(columns)] if symmetric else [columns]
+    shard = list()
+    for otus in scored_tables(names, sides):
+        otus.columns['index'] = numpy.arange(start, end)
+        shard.append((otus.pval, otus.filter(
+            (otus.interest_frac >= cfg['min_frac']) &
+            (otus.out_frac <= cfg['max_out_presence']))))
+    return shard
+
+
+def gather_shards(shards, cfg):
+    """Find the core from the process_shard results for one side of every
+    shard of the table, in order. The p-values are corrected over the whole
+    table before the candidates are filtered by them"""
+    corrected = correct_pvalues(numpy.concatenate([pvals for pvals, otus
+                                                   in shards]),
+                                cfg['p_val_adj'])
+    otus = concatenate_tables([otus for pvals, otus in shards])
+    otus.columns['corrected_pval'] = corrected[otus.columns.pop('index')]
+    return core(otus, cfg)
+
+
+def encode_shard(shard):
+    """Encode a result of process_shard as a compressed npz archive"""
+    arrays = dict()
+    for side, (pvals, otus) in enumerate(shard):
+        arrays['pvals_%d' % side] = pvals
+        for attr, column in otus.columns.iteritems():
+            arrays['%d_%s' % (side, attr)] = column
+    f = StringIO()
+    numpy.savez_compressed(f, **arrays)
+    return f.getvalue()
+
+
+def decode_shard(payload, names):
+    """Decode a result of process_shard encoded by encode_shard, given the
+    names of the OTUs of the whole table"""
+    archive = numpy.load(StringIO(payload))
+    names = numpy.asarray(names, dtype=object)
+    shard = list()
+    side = 0
+    while 'pvals_%d' % side in archive.files:
+        prefix = '%d_' % side
+        columns = dict((key[len(prefix):], archive[key])
+                       for key in archive.files if key.startswith(prefix))
+        shard.append((archive['pvals_%d' % side],
+                      OtuTable(names[columns['index']], columns)))
+        side += 1
+    return shard
+
+
+def sweep(inputs, cfg, chunk_bytes=CHUNK_BYTES):
+    """Finds the core OTUs for every combination of the min_abundance, max_p,
+    min_frac, and max_out_presence values in cfg, each of which may be a
+    list. The statistics and p-values of the OTUs are only calculated once for
+    each min_abundance. Returns a list of pairs of the configuration for each
+    combination and its core"""
+    tables = otu_tables(inputs, cfg, chunk_bytes)
+    return [(point, core(tables[point['min_abundance']], point))
+            for point in sweep_cfgs(cfg)]
+
+
+def sweep_cfgs(cfg):
+    """The configurations for each combination of the values of the
+    min_abundance, max_p, min_frac, and max_out_presence lists in cfg"""
+    return [dict(cfg, min_abundance=min_abundance, max_p=max_p,
+                 min_frac=min_frac, max_out_presence=max_out_presence)
+            for min_abundance in as_list(cfg['min_abundance'])
+            for max_p in as_list(cfg['max_p'])
+            for min_frac in as_list(cfg['min_frac'])
+            for max_out_presence in as_list(cfg['max_out_presence'])]
+
+
+def otu_tables(inputs, cfg, chunk_bytes=CHUNK_BYTES):
+    """Calculates the statistics and corrected p-values of every OTU for each
+    of the min_abundance values in cfg, which may be a list. The presence
+    counts for all of them are found in one pass over the table, and the
+    p-values of counts that occur for several are only calculated once.
+    Returns a dictionary from min_abundance to OtuTable"""
+    table = inputs['filtered_data']
+    i_mask = interest_mask(inputs['mapping_dict'], cfg['group'],
+                           table.sample_ids)
+    thresholds = as_list(cfg['min_abundance'])
+    stats = block_stats(table, lambda values: abundance_sweep_stats(
+        values, i_mask, thresholds), chunk_bytes)
+    return dict(zip(thresholds, scored_tables(table.observation_ids, stats,
+                                              cfg['p_val_adj'])))
+
+
+def block_stats(table, stats, chunk_bytes=CHUNK_BYTES):
+    """Call stats on each block of OTUs of the table, as a dense matrix of
+    about chunk_bytes, rather than on the whole table at once. stats returns
+    nested lists of dictionaries of arrays with an entry for each OTU, and
+    the arrays of the blocks are joined in the same structure"""
+    return concatenate_stats([stats(table.dense(start, end))
+                              for start, end
+                              in shard_ranges(table.shape, chunk_bytes // 8)])
+
+
+def concatenate_stats(blocks):
+    """Join the arrays of the given list of results of stats for block_stats"""
+    if isinstance(blocks[0], dict):
+        return dict((attr, numpy.concatenate([block[attr]
+                                              for block in blocks]))
+                    for attr in blocks[0])
+    return [concatenate_stats([block[i] for block in blocks])
+            for i in xrange(len(blocks[0]))]
+
+
+def interest_mask(mapping_dict, group, sample_ids):
+    """Boolean array that is True for the given samples in the groups of
+    mapping_dict listed in group"""
+    interest_ids = set([otu for g in group for otu in mapping_dict[g]])
+    return numpy.array([id in interest_ids for id in sample_ids], dtype=bool)
+
+
+def one_vs_rest(inputs, cfg, chunk_bytes=CHUNK_BYTES):
+    """Finds the core OTUs of every group of the factor against the rest of
+    the samples, for every combination of thresholds in cfg as sweep does. The
+    presence counts of all the groups come from a single product of the
+    presence matrix with a matrix indicating the group of each sample. Returns
+    a list of pairs of the configuration and core for each group and
+    combination, ordered by group. If cfg has a list of levels only those
+    groups are taken as the interest group"""
+    table = inputs['filtered_data']
+    levels, groups = group_indicator(inputs['mapping_dict'], table.sample_ids)
+    selected = [levels.index(level) for level in cfg.get('levels') or levels]
+    thresholds = as_list(cfg['min_abundance'])
+    levels_stats = block_stats(table, lambda values: one_vs_rest_stats(
+        values, groups[:, selected], thresholds), chunk_bytes)
+    scored = scored_tables(table.observation_ids,
+                           [columns for level_stats in levels_stats
+                            for columns in level_stats], cfg['p_val_adj'])
+
+    results = list()
+    for i, level in enumerate(levels[g] for g in selected):
+        tables = dict(zip(thresholds, scored[i * len(thresholds):
+                                             (i + 1) * len(thresholds)]))
+        level_cfg = dict(cfg, group=[level],
+                         out_group=[l for l in levels if l != level])
+        results += [(point, core(tables[point['min_abundance']], point))
+                    for point in sweep_cfgs(level_cfg)]
+    return results
+
+
+def contrasts(inputs, cfg, chunk_bytes=CHUNK_BYTES):
+    """Finds the core OTUs of every group of the factor relative to each other
+    group, ignoring the samples in neither, for every combination of
+    thresholds in cfg as sweep does. The presence counts of every group are
+    found once, a block of OTUs at a time, and each pair's contingency tables
+    follow from them. The pairs are scored in batches whose statistics take
+    about chunk_bytes, and only the core of each pair is kept. Returns a list
+    of pairs of the configuration and core for each ordered pair of groups and
+    combination. If cfg has a list of levels only the pairs with those groups
+    as the interest group are found"""
+    table = inputs['filtered_data']
+    levels, groups = group_indicator(inputs['mapping_dict'], table.sample_ids)
+    pairs = [(levels.index(level), b)
+             for level in cfg.get('levels') or levels
+             for b in xrange(len(levels)) if levels[b] != level]
+    if not pairs:
+        return []
+    thresholds = as_list(cfg['min_abundance'])
+    totals = table_group_sums(table, groups, thresholds, chunk_bytes)
+
+    results = list()
+    stats_cells = len(table.observation_ids) * len(thresholds) * STATS_COLUMNS
+    for first, last in shard_ranges((len(pairs), stats_cells),
+                                    chunk_bytes // 8):
+        batch = pairs[first:last]
+        # One batch of Fisher's exact tests for every pair and threshold
+        scored = scored_tables(table.observation_ids,
+                               [columns for pair_stats
+                                in contrast_stats(totals, batch)
+                                for columns in pair_stats], cfg['p_val_adj'])
+        for i, (a, b) in enumerate(batch):
+            tables = dict(zip(thresholds, scored[i * len(thresholds):
+                                                 (i + 1) * len(thresholds)]))
+            pair_cfg = dict(cfg, group=[levels[a]], out_group=[levels[b]])
+            results += [(point, core(tables[point['min_abundance']], point))
+                        for point in sweep_cfgs(pair_cfg)]
+        del scored
+    return results
+
+
+def table_group_sums(table, groups, thresholds, chunk_bytes=CHUNK_BYTES):
+    """group_sums of the whole table, found a block of OTUs taking about
+    chunk_bytes as a dense matrix at a time"""
+    blocks = [group_sums(table.dense(start, end), groups, thresholds)
+              for start, end in shard_ranges(table.shape, chunk_bytes // 8)]
+    return (blocks[0][0],
+            numpy.concatenate([sums for n, sums, squares, present
+                               in blocks]),
+            numpy.concatenate([squares for n, sums, squares, present
+                               in blocks]),
+            [numpy.concatenate([present[t] for n, sums, squares, present
+                                in blocks])
+             for t in xrange(len(thresholds))])
+
+
+def group_indicator(mapping_dict, sample_ids):
+    """The sorted groups of mapping_dict, and a boolean matrix with a row for
+    each of the given samples and a column for each group that is True where
+    the sample is in the group"""
+    levels = sorted(mapping_dict)
+    members = [set(mapping_dict[level]) for level in levels]
+    groups = numpy.array([[id in samples for samples in members]
+                          for id in sample_ids], dtype=bool)
+    return levels, groups.reshape((len(sample_ids), len(levels)))
+
+
+def scored_tables(names, stats, p_val_adj=None):
+    """OtuTables of each of the given dictionaries of statistics, with the
+    p-values of the OTUs added. If p_val_adj is given the corrected p-values
+    are added as well. The p-values of all the tables are calculated in one
+    batch"""
+    pvals = getpvals(*[numpy.concatenate([columns[attr] for columns in stats])
+                       for attr in ('present', 'interest_present',
+                                    'interest', 'total')])
+    tables = list()
+    for i, columns in enumerate(stats):
+        otus = OtuTable(names, columns)
+        otus.columns['pval'] = pvals[i * len(names):(i + 1) * len(names)]
+        if p_val_adj is not None:
+            otus.columns['corrected_pval'] = correct_pvalues(otus.pval,
+                                                             p_val_adj)
+        tables.append(otus)
+    return tables
+
+
+def concatenate_tables(tables):
+    """A single OtuTable of the OTUs of the given OtuTables, which must all
+    have the same attributes"""
+    return OtuTable(numpy.concatenate([otus.names for otus in tables]),
+                    dict((attr, numpy.concatenate([otus.columns[attr]
+                                                   for otus in tables]))
+                         for attr in tables[0].columns))
+
+
+def core(otus, cfg):
+    """Filter the given OtuTable down to the core"""
+    return otus.filter((otus.corrected_pval <= cfg['max_p']) &
+                       (otus.interest_frac >= cfg['min_frac']) &
+                       (otus.out_frac <= cfg['max_out_presence']))
 
 
 def format_results(res, cfg):
@@ -58,7 +332,27 @@ def format_results(res, cfg):
     # Combine inputs, header, and information from core OTUs
     return to_tsv([inputs, header] +
                   [[otu.name, otu.pval, otu.corrected_pval, otu.interest_frac,
-                    otu.out_frac] for otu in list(sorted(res))])
+                    otu.out_frac] for otu in res.sorted(cfg['top'])])
+
+
+def format_sweep_results(results, cfg, pairs=False):
+    """Format the results of a sweep, one_vs_rest, or contrasts as a single
+    tsv, with a row for each core OTU of each group and combination of
+    thresholds. If pairs is set the out group of each is given as well"""
+    inputs = ['#Factor: ' + cfg['factor'],
+              'Correction Type: ' + cfg['p_val_adj']]
+    header = (['#Group'] + (['Out Group'] if pairs else []) +
+              ['Min Abundance', 'Max Corrected p-val', 'Min Presence',
+               'Max Out Presence', 'OTU', 'Pval', 'Corrected Pval',
+               'Interest Group Presence', 'Out Group Presence'])
+    return to_tsv([inputs, header] +
+                  [[', '.join(point['group'])] +
+                   ([', '.join(point['out_group'])] if pairs else []) +
+                   [point['min_abundance'], point['max_p'], point['min_frac'],
+                    point['max_out_presence'], otu.name, otu.pval,
+                    otu.corrected_pval, otu.interest_frac, otu.out_frac]
+                   for point, res in results
+                   for otu in res.sorted(point['top'])])
 
 
 def to_tsv(values):
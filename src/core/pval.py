@@ -17,71 +17,216 @@
 # along with Coremic. If not, see <http://www.gnu.org/licenses/>.
 
 
-def getpval(otu):
-    """The probability that if n_interest valsues are chosen from vals the
-    number present in the interest group will be as many or greater than what
-    was originally found. This is calculated with a one-tailed Fisher's Exact
-    Test
-    """
-    return sum(
-        [nCr(otu.present, need) * nCr(otu.absent, otu.interest - need)
-         for need in xrange(otu.interest_present,
-                            min(otu.present, otu.interest) + 1)]
-    ) / nCr(otu.total, otu.interest)
+import numpy
+from math import lgamma
+from collections import OrderedDict
+
+# Table of log(k!), indexed by k. Grown as needed by log_factorials
+_log_factorials = numpy.zeros(1)
+
+# Default number of contingency tables whose p-values are remembered
+PVAL_CACHE_SIZE = 50000
+
+
+def log_factorials(n):
+    """Table of the natural logs of the factorials of 0 through at least n"""
+    global _log_factorials
+    if len(_log_factorials) <= n:
+        _log_factorials = numpy.array([lgamma(k + 1) for k in xrange(n + 1)])
+    return _log_factorials
+
+
+def log_nCr(n, r, log_fact):
+    """Natural log of n Choose r, looked up in the given log factorial table.
+    r may be an array"""
+    return log_fact[n] - log_fact[r] - log_fact[n - r]
+
+
+def group_rows(*keys):
+    """Groups the rows of the given equal length arrays that have the same
+    value in every array. Returns the indices that sort the rows into groups
+    and the index of the start of each group in that order"""
+    order = numpy.lexsort(keys)
+    starts = numpy.zeros(len(order), dtype=bool)
+    starts[:1] = True
+    for key in keys:
+        key = key[order]
+        starts[1:] |= key[1:] != key[:-1]
+    return order, numpy.flatnonzero(starts)
+
+
+class PvalCache(object):
+    """Bounded cache from (present, interest_present, interest, total) count
+    tuples to their p-values. When full the least recently used entry is
+    evicted. Counts the hits and misses of lookups"""
+    def __init__(self, max_size=PVAL_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._pvals = OrderedDict()
+
+    def get(self, key):
+        """The cached p-value for key, or None if it isn't cached"""
+        pval = self._pvals.pop(key, None)
+        if pval is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._pvals[key] = pval  # Now the most recently used
+        return pval
+
+    def put(self, key, pval):
+        self._pvals.pop(key, None)
+        self._pvals[key] = pval
+        while len(self._pvals) > self.max_size:
+            self._pvals.popitem(last=False)
+
+    def clear(self):
+        self._pvals.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._pvals), 'max_size': self.max_size}
+
+    def __len__(self):
+        return len(self._pvals)
 
 
-def nCr(n, r):
-    """n Choose r
-    Uses floating point arithemetic
+# Shared by every run in this process
+PVAL_CACHE = PvalCache()
+
+
+def getpvals(present, interest_present, interest, total, cache=PVAL_CACHE):
+    """The probability for each OTU that if interest values are chosen from
+    its total values the number present in the interest group will be as many
+    or greater than what was originally found. This is calculated with a
+    one-tailed Fisher's Exact Test. Arguments are arrays with an entry per OTU
+    (or scalars shared by all of them) and an array of p-values is returned.
+    Each distinct count tuple is only tested once, and tuples whose p-values
+    are in the given cache are not tested at all
     """
-    assert 0 <= n
-    assert 0 <= r and r <= n
-    num = 1.0
-    denom = 1.0
-    for t in xrange(1, min(r, n - r) + 1):
-        num *= n
-        denom *= t
-        n -= 1
-    return num / denom
+    present, interest_present, interest, total = numpy.broadcast_arrays(
+        *[numpy.asarray(a, dtype=int)
+          for a in (present, interest_present, interest, total)])
+    shape = present.shape
+    present, interest_present, interest, total = [
+        a.ravel() for a in (present, interest_present, interest, total)]
+    if not len(present):
+        return numpy.zeros(shape)
+
+    order, starts = group_rows(present, interest_present, interest, total)
+    firsts = order[starts]
+    keys = zip(present[firsts].tolist(), interest_present[firsts].tolist(),
+               interest[firsts].tolist(), total[firsts].tolist())
+    unique_pvals = numpy.zeros(len(keys))
+    missing = list()
+    for i, key in enumerate(keys):
+        pval = cache.get(key) if cache is not None else None
+        if pval is None:
+            missing.append(i)
+        else:
+            unique_pvals[i] = pval
+    if missing:
+        rows = firsts[missing]
+        unique_pvals[missing] = fisher_test(present[rows],
+                                            interest_present[rows],
+                                            interest[rows], total[rows])
+        if cache is not None:
+            for i in missing:
+                cache.put(keys[i], unique_pvals[i])
+
+    # Spread the p-value of each distinct tuple back to the OTUs sharing it
+    group_sizes = numpy.diff(numpy.append(starts, len(order)))
+    pvals = numpy.zeros(len(order))
+    pvals[order] = numpy.repeat(unique_pvals, group_sizes)
+    return pvals.reshape(shape)
+
+
+def fisher_test(present, interest_present, interest, total):
+    """One-tailed Fisher's Exact Test of the given arrays of counts,
+    calculated in log space so that it stays finite for large numbers of
+    samples"""
+    pvals = numpy.zeros(len(present))
+    log_fact = log_factorials(total.max())
+
+    # Tests with the same present, interest, and total counts share the same
+    # hypergeometric distribution, so its tail sums are calculated once and
+    # each test's p-value is a lookup into them
+    order, starts = group_rows(present, interest, total)
+    for start, end in zip(starts, list(starts[1:]) + [len(order)]):
+        rows = order[start:end]
+        n, m, N = present[rows[0]], interest[rows[0]], total[rows[0]]
+        low, high = max(0, m - (N - n)), min(n, m)
+        need = numpy.arange(low, high + 1)
+        log_pmf = (log_nCr(n, need, log_fact) +
+                   log_nCr(N - n, m - need, log_fact) -
+                   log_nCr(N, m, log_fact))
+        # log of the sum of the probabilities from each need to the end
+        tails = numpy.append(numpy.logaddexp.accumulate(log_pmf[::-1])[::-1],
+                             -numpy.inf)
+        pvals[rows] = numpy.exp(tails[numpy.clip(interest_present[rows] - low,
+                                                 0, len(tails) - 1)])
+    return numpy.minimum(pvals, 1.0)
 
 
 def correct_pvalues(pvalues, correction_type):
-    """Applies the given correction method to the given pvalues to correct for
-    multiple testing errors"""
+    """Applies the given correction method to the given array of pvalues to
+    correct for multiple testing errors"""
+    pvalues = numpy.asarray(pvalues, dtype=float)
     if correction_type == 'bf':
         return bonferroni_correct(pvalues)
     elif correction_type == 'bf-h':
         return bonferroni_holm_correct(pvalues)
     elif correction_type == 'b-h':
         return benjamini_hotchberg_correct(pvalues)
+    elif correction_type == 'b-y':
+        return benjamini_yekutieli_correct(pvalues)
     else:
-        return pvalues[:]
+        return pvalues.copy()
 
 
 def bonferroni_correct(pvalues):
-    return [len(pvalues) * p for p in pvalues]
+    return numpy.minimum(len(pvalues) * pvalues, 1.0)
 
 
 def bonferroni_holm_correct(pvalues):
     n = len(pvalues)
-    values = sorted([(p, i) for i, p in enumerate(pvalues)])
-    new_pvalues = [None] * n
-    for rank, (p, i) in enumerate(values):
-        new_pvalues[i] = (n - rank) * p
-    return new_pvalues
+    return step_down_correct(pvalues, n - numpy.arange(n, dtype=float))
 
 
 def benjamini_hotchberg_correct(pvalues):
     n = len(pvalues)
-    values = list(reversed(sorted(
-        [(p, i) for i, p in enumerate(pvalues)]
-    )))
-    adjusted_vals = [float(n)/(n - i) * p
-                     for i, (p, index) in enumerate(values)]
-    for i in xrange(n - 1):
-        if adjusted_vals[i] < adjusted_vals[i + 1]:
-            adjusted_vals[i + 1] = adjusted_vals[i]
-    new_pvalues = [None] * n
-    for i, (p, index) in enumerate(values):
-        new_pvalues[index] = adjusted_vals[i]
-    return new_pvalues
+    return step_up_correct(pvalues, float(n) / numpy.arange(1, n + 1))
+
+
+def benjamini_yekutieli_correct(pvalues):
+    n = len(pvalues)
+    harmonic = (1.0 / numpy.arange(1, n + 1)).sum()
+    return step_up_correct(pvalues,
+                           harmonic * float(n) / numpy.arange(1, n + 1))
+
+
+def step_down_correct(pvalues, factors):
+    """Multiplies the ith smallest p-value by factors[i], then makes the
+    results non-decreasing from the smallest p-value up"""
+    order = numpy.argsort(pvalues, kind='mergesort')
+    adjusted = numpy.maximum.accumulate(factors * pvalues[order])
+    return unsort(numpy.minimum(adjusted, 1.0), order)
+
+
+def step_up_correct(pvalues, factors):
+    """Multiplies the ith smallest p-value by factors[i], then makes the
+    results non-increasing from the largest p-value down"""
+    order = numpy.argsort(pvalues, kind='mergesort')
+    adjusted = numpy.minimum.accumulate((factors * pvalues[order])[::-1])[::-1]
+    return unsort(numpy.minimum(adjusted, 1.0), order)
+
+
+def unsort(values, order):
+    """Puts values, which are in the given sorted order, back into the
+    original order"""
+    unsorted = numpy.zeros(len(values))
+    unsorted[order] = values
+    return unsorted
@@ -0,0 +1,139 @@
+# Copyright 2016, 2017 Richard Rodrigues, Nyle Rodgers, Mark Williams,
+# Virginia Tech
+#
+# This file is part of Coremic.
+#
+# Coremic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Coremic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Coremic. If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import zlib
+import struct
+import numpy
+
+# Binary format of Tables: a header of the format's magic string, version,
+# shape, number of nonzero entries, and size of the ids, followed by the zlib
+# compressed indptr, indices, and data arrays and the JSON encoded ids. The
+# arrays are always little endian, so that they can be decoded in place
+MAGIC = 'CMTB'
+VERSION = 1
+HEADER = struct.Struct('<4sBQQQQ')
+INDPTR_TYPE = numpy.dtype('<i8')
+INDICES_TYPE = numpy.dtype('<i4')
+DATA_TYPE = numpy.dtype('<f8')
+
+
+class Table(object):
+    """OTU table with a row for each observation and a column for each sample,
+    stored in compressed sparse row form: the nonzero values of row i are
+    data[indptr[i]:indptr[i + 1]], in the columns given by the same slice of
+    indices"""
+    def __init__(self, data, indices, indptr, sample_ids, observation_ids):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.sample_ids = list(sample_ids)
+        self.observation_ids = list(observation_ids)
+
+    @classmethod
+    def from_triplets(cls, rows, columns, values, sample_ids,
+                      observation_ids):
+        """Construct from the rows, columns, and values of the nonzero
+        entries. There must be at most one entry for each row and column"""
+        order = numpy.argsort(rows, kind='mergesort')
+        indptr = numpy.append(0, numpy.cumsum(numpy.bincount(
+            rows, minlength=len(observation_ids))))
+        return cls(numpy.asarray(values, dtype=float)[order],
+                   numpy.asarray(columns, dtype=int)[order], indptr,
+                   sample_ids, observation_ids)
+
+    @classmethod
+    def from_dense(cls, matrix, sample_ids, observation_ids):
+        rows, columns = matrix.nonzero()
+        return cls.from_triplets(rows, columns, matrix[rows, columns],
+                                 sample_ids, observation_ids)
+
+    @property
+    def shape(self):
+        return (len(self.observation_ids), len(self.sample_ids))
+
+    def triplets(self):
+        """The rows, columns, and values of the nonzero entries"""
+        rows = numpy.repeat(numpy.arange(len(self.observation_ids)),
+                            numpy.diff(self.indptr))
+        return rows, self.indices, self.data
+
+    def dense(self, start=0, end=None):
+        """The rows from start up to end as a two dimensional array"""
+        if end is None:
+            end = len(self.observation_ids)
+        matrix = numpy.zeros((end - start, len(self.sample_ids)))
+        first, last = self.indptr[start], self.indptr[end]
+        rows = numpy.repeat(numpy.arange(end - start),
+                            numpy.diff(self.indptr[start:end + 1]))
+        matrix[rows, self.indices[first:last]] = self.data[first:last]
+        return matrix
+
+    def rows(self, start, end):
+        """A table of just the rows from start up to end, sharing the data
+        and indices arrays of this one"""
+        first, last = self.indptr[start], self.indptr[end]
+        return Table(self.data[first:last], self.indices[first:last],
+                     self.indptr[start:end + 1] - first, self.sample_ids,
+                     self.observation_ids[start:end])
+
+    def to_bytes(self):
+        """Encode the table in the binary format read by from_bytes"""
+        ids = json.dumps([self.sample_ids, self.observation_ids])
+        if isinstance(ids, unicode):
+            ids = ids.encode('utf-8')
+        nnz = len(self.data)
+        compressor = zlib.compressobj()
+        body = [compressor.compress(numpy.asarray(array, dtype=dtype)
+                                    .tostring())
+                for array, dtype in ((self.indptr, INDPTR_TYPE),
+                                     (self.indices, INDICES_TYPE),
+                                     (self.data, DATA_TYPE))]
+        body += [compressor.compress(ids), compressor.flush()]
+        return HEADER.pack(MAGIC, VERSION, len(self.observation_ids),
+                           len(self.sample_ids), nnz, len(ids)) + ''.join(body)
+
+    @classmethod
+    def from_bytes(cls, payload):
+        """Decode a table encoded by to_bytes. The arrays of the table are
+        read only views of the decompressed payload rather than copies"""
+        if len(payload) < HEADER.size:
+            raise ValueError('Table data is truncated')
+        (magic, version, n_observations, n_samples,
+         nnz, ids_size) = HEADER.unpack_from(payload)
+        if magic != MAGIC:
+            raise ValueError('Not a table')
+        if version != VERSION:
+            raise ValueError('Unsupported table format version %d' % version)
+        try:
+            body = zlib.decompress(buffer(payload, HEADER.size))
+        except zlib.error:
+            raise ValueError('Table data is corrupt')
+        sizes = [(n_observations + 1) * INDPTR_TYPE.itemsize,
+                 nnz * INDICES_TYPE.itemsize, nnz * DATA_TYPE.itemsize]
+        if len(body) != sum(sizes) + ids_size:
+            raise ValueError('Table data is corrupt')
+        offsets = numpy.cumsum([0] + sizes)
+        indptr, indices, data = [
+            numpy.frombuffer(body, dtype=dtype, count=size // dtype.itemsize,
+                             offset=offset)
+            for dtype, size, offset in zip((INDPTR_TYPE, INDICES_TYPE,
+                                            DATA_TYPE), sizes, offsets)]
+        sample_ids, observation_ids = json.loads(body[offsets[-1]:])
+        return cls(data, indices, indptr, sample_ids, observation_ids)
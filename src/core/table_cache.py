@@ -0,0 +1,141 @@
+# Copyright 2016, 2017 Richard Rodrigues, Nyle Rodgers, Mark Williams,
+# Virginia Tech
+#
+# This file is part of Coremic.
+#
+# Coremic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Coremic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Coremic. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy
+
+from table import Table
+
+# Default limit on the total size of the cached tables
+MAX_CACHE_BYTES = 1 << 30
+# Number of bytes of a datafile hashed at a time
+HASH_CHUNK_SIZE = 1 << 20
+
+# Arrays of a Table, each stored in its own .npy file so it can be memory
+# mapped
+ARRAYS = ('data', 'indices', 'indptr')
+IDS_FILE = 'ids.json'
+
+
+def table_key(datafiles, options):
+    """Key for the table read from the given datafiles, each a string or an
+    open file, with the given dictionary of options"""
+    key = hashlib.sha1()
+    for datafile in datafiles:
+        key.update(content_hash(datafile))
+    key.update(json.dumps(options, sort_keys=True))
+    return key.hexdigest()
+
+
+def content_hash(datafile):
+    """Hash of the contents of the given string or open file. Files are read
+    from and returned to their start"""
+    content = hashlib.sha1()
+    if isinstance(datafile, basestring):
+        if isinstance(datafile, unicode):
+            datafile = datafile.encode('utf-8')
+        content.update(datafile)
+    else:
+        datafile.seek(0)
+        for chunk in iter(lambda: datafile.read(HASH_CHUNK_SIZE), ''):
+            content.update(chunk)
+        datafile.seek(0)
+    return content.hexdigest()
+
+
+class TableCache(object):
+    """Cache of parsed and combined tables in a directory. Each table is kept
+    as .npy files of its arrays, which are memory mapped when it is loaded.
+    When the cached tables take more than max_bytes the least recently used
+    are removed"""
+    def __init__(self, directory, max_bytes=MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+        """The table cached under key, or None if there isn't one"""
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            return None
+        os.utime(path, None)    # Now the most recently used
+        return load_table(path)
+
+    def put(self, key, table):
+        """Cache table under key"""
+        # Written to a temporary directory first so that a partly written
+        # table is never read
+        tmp = tempfile.mkdtemp(dir=self.directory)
+        save_table(tmp, table)
+        try:
+            os.rename(tmp, os.path.join(self.directory, key))
+        except OSError:         # Already cached by another process
+            shutil.rmtree(tmp)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Remove the least recently used tables, other than the one cached
+        under keep, until the cache is within its size limit"""
+        entries = list()
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if not is_key(key) or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, name))
+                       for name in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, key, path))
+        total = sum(size for mtime, size, key, path in entries)
+        for mtime, size, key, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+def save_table(directory, table):
+    """Write table to the given existing directory, as a .npy file for each of
+    its arrays along with its ids"""
+    for name in ARRAYS:
+        numpy.save(os.path.join(directory, name + '.npy'),
+                   getattr(table, name))
+    with open(os.path.join(directory, IDS_FILE), 'w') as f:
+        json.dump({'sample_ids': table.sample_ids,
+                   'observation_ids': table.observation_ids}, f)
+
+
+def load_table(directory):
+    """Load a table written by save_table, memory mapping its arrays"""
+    with open(os.path.join(directory, IDS_FILE)) as f:
+        ids = json.load(f)
+    arrays = [numpy.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+              for name in ARRAYS]
+    return Table(*arrays, sample_ids=ids['sample_ids'],
+                 observation_ids=ids['observation_ids'])
+
+
+def is_key(name):
+    """Whether name is a key made by table_key, rather than a temporary
+    directory"""
+    return len(name) == 40 and all(c in '0123456789abcdef' for c in name)
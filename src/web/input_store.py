@@ -0,0 +1,155 @@
+# Copyright 2016, 2017 Richard Rodrigues, Nyle Rodgers, Mark Williams,
+# Virginia Tech
+#
+# This file is part of Coremic.
+#
+# Coremic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Coremic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Coremic. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import uuid
+import shutil
+import hashlib
+import tempfile
+from StringIO import StringIO
+
+# The Cloud Storage client is only available on App Engine
+try:
+    import cloudstorage
+except ImportError:
+    cloudstorage = None
+
+# Number of bytes copied in to the store at a time
+CHUNK_SIZE = 1 << 20
+# Setting this environment variable to a directory stores inputs there
+# instead of in Cloud Storage
+LOCAL_STORE_VARIABLE = 'COREMIC_INPUT_DIR'
+# Number of days after which stored objects are deleted by the lifecycle rule
+# of the bucket, set from lifecycle.json by `make lifecycle`. It must be
+# longer than any run and than the results are cached for. Storing an object
+# again restarts its age, so that it is not deleted while still in use
+INPUT_TTL_DAYS = 2
+
+
+def default_store():
+    """The store inputs are kept in, shared by the request handlers and the
+    pipeline"""
+    directory = os.getenv(LOCAL_STORE_VARIABLE)
+    if directory:
+        return LocalInputStore(directory)
+    from google.appengine.api import app_identity
+    return CloudStorageInputStore(app_identity.get_default_gcs_bucket_name())
+
+
+def copy_hashed(source, destination):
+    """Copy the string or file source to the file destination a chunk at a
+    time, returning the hash of the contents"""
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    if isinstance(source, str):
+        source = StringIO(source)
+    content = hashlib.sha1()
+    for chunk in iter(lambda: source.read(CHUNK_SIZE), ''):
+        content.update(chunk)
+        destination.write(chunk)
+    return content.hexdigest()
+
+
+class LocalInputStore(object):
+    """Inputs kept as files in a directory, named by the hash of their
+    contents. Used instead of Cloud Storage when testing"""
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def put(self, source, key=None):
+        """Store the given string or file, returning the key it can be opened
+        with. That is the hash of its contents, unless a key is given, in
+        which case anything already stored under it is replaced"""
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            content = copy_hashed(source, f)
+        key = key or content
+        path = self.path(key)
+        if key == content and os.path.exists(path):
+            # Identical contents were already stored
+            os.remove(tmp)
+            os.utime(path, None)
+        else:
+            shutil.move(tmp, path)
+        return key
+
+    def open(self, key):
+        """Open the input stored under key for reading"""
+        return open(self.path(key), 'rb')
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def delete(self, key):
+        if self.exists(key):
+            os.remove(self.path(key))
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+
+class CloudStorageInputStore(object):
+    """Inputs kept as objects in a Cloud Storage bucket, named by the hash of
+    their contents"""
+    def __init__(self, bucket, prefix='inputs'):
+        if cloudstorage is None:
+            raise ValueError('Cloud Storage client is not available')
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, source, key=None):
+        """Store the given string or file, returning the key it can be opened
+        with. That is the hash of its contents, unless a key is given, in
+        which case anything already stored under it is replaced"""
+        if key is not None:
+            with cloudstorage.open(self.path(key), 'w') as f:
+                copy_hashed(source, f)
+            return key
+        # The hash is only known once it has all been written, so it is
+        # written under a temporary name and then copied. Identical contents
+        # that were already stored are replaced as well, which restarts
+        # their age for the bucket's lifecycle rule
+        tmp = '/%s/%s/tmp/%s' % (self.bucket, self.prefix, uuid.uuid4().hex)
+        with cloudstorage.open(tmp, 'w') as f:
+            key = copy_hashed(source, f)
+        cloudstorage.copy2(tmp, self.path(key))
+        cloudstorage.delete(tmp)
+        return key
+
+    def open(self, key):
+        """Open the input stored under key for reading"""
+        return cloudstorage.open(self.path(key))
+
+    def exists(self, key):
+        try:
+            cloudstorage.stat(self.path(key))
+            return True
+        except cloudstorage.NotFoundError:
+            return False
+
+    def delete(self, key):
+        try:
+            cloudstorage.delete(self.path(key))
+        except cloudstorage.NotFoundError:
+            pass
+
+    def path(self, key):
+        return '/%s/%s/%s' % (self.bucket, self.prefix, key)
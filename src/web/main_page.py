@@ -19,11 +19,14 @@
 
 import webapp2
 from time import localtime, strftime
-import cPickle
+from StringIO import StringIO
 
 import web_config
 from run_pipeline import RunPipeline
-from ..core.parse_inputs import parse_inputs
+from input_store import default_store
+from result_cache import result_key
+from ..core.parse_inputs import validate_inputs
+from ..core.parse_biom import check_biom, h5py
 
 
 class MainPage(webapp2.RequestHandler):
@@ -36,7 +39,8 @@ class MainPage(webapp2.RequestHandler):
         timestamp = strftime('%a-%d-%b-%Y-%I:%M:%S-%p', localtime())
 
         run_name = self.request.get('name')
-        data_files = self.request.get_all('datafile')
+        uploads = [getattr(upload, 'file', upload)
+                   for upload in self.request.POST.getall('datafile')]
         mapping_file = self.request.get('groupfile').split('\n')
 
         factor = self.request.get('factor')
@@ -72,16 +76,31 @@ class MainPage(webapp2.RequestHandler):
             'max_out_presence': max_out_presence,
             'make_relative': make_relative,
             'quantile_normalize': quantile_normalize,
+            'quantile_ties': 'first',
+            'include_out': include_out,
         }
 
-        errors_list, mapping_dict, out_group, filtered_data = parse_inputs(
-            params, mapping_file, data_files)
+        # Only the quick checks are done here, the datafiles are read in the
+        # pipeline's first stage so that large uploads don't hold up the
+        # request
+        errors_list, mapping_dict, out_group = validate_inputs(params,
+                                                               mapping_file)
+        for i, upload in enumerate(uploads):
+            if isinstance(upload, basestring):
+                upload = StringIO(upload)
+            try:
+                # HDF5 files can only be read where h5py is installed,
+                # which it isn't on App Engine
+                check_biom(upload, allow_hdf5=h5py is not None)
+            except ValueError as e:
+                errors_list.append('Datafile %d could not be read: %s' %
+                                   (i + 1, e.message))
+        if not uploads:
+            errors_list.append('No datafiles were given')
 
         params['out_group'] = out_group
         inputs = {
             'mapping_dict': mapping_dict,
-            # Must be packed up to be able to pass to the process_data task
-            'filtered_data': cPickle.dumps(filtered_data),
         }
 
         params['run_cfgs'] = [{
@@ -97,6 +116,7 @@ class MainPage(webapp2.RequestHandler):
             'max_p': max_p,
             'min_frac': min_frac,
             'p_val_adj': p_val_adj,
+            'top': None,
             'make_relative': make_relative,
             'quantile_normalize': quantile_normalize,
         }]
@@ -115,6 +135,7 @@ class MainPage(webapp2.RequestHandler):
                 'max_p': max_p,
                 'min_frac': min_frac,
                 'p_val_adj': p_val_adj,
+                'top': None,
                 'make_relative': make_relative,
                 'quantile_normalize': quantile_normalize,
             })
@@ -125,6 +146,13 @@ class MainPage(webapp2.RequestHandler):
                                                 sucess=False))
             return
 
+        # The uploads are copied to the input store as streams, and the
+        # pipeline is only given their keys
+        store = default_store()
+        params['datafile_keys'] = [store.put(upload) for upload in uploads]
+        # Identical submissions share their results
+        params['result_key'] = result_key(params, inputs)
+
         pipeline = RunPipeline(params, inputs)
         pipeline.start()
 
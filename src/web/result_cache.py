@@ -0,0 +1,297 @@
+# Copyright 2016, 2017 Richard Rodrigues, Nyle Rodgers, Mark Williams,
+# Virginia Tech
+#
+# This file is part of Coremic.
+#
+# Coremic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Coremic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Coremic. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+from input_store import default_store, LOCAL_STORE_VARIABLE
+
+# The datastore is only available on App Engine
+try:
+    from google.appengine.ext import ndb
+except ImportError:
+    ndb = None
+
+# Number of seconds finished results are kept for. The attachments are only
+# deleted by the input store's lifecycle rule, so this must be shorter than
+# INPUT_TTL_DAYS for them to outlive their entries
+RESULT_TTL = 24 * 60 * 60
+# Number of seconds after which a run that has not finished is assumed to
+# have died, so that an identical submission takes it over, along with the
+# requesters waiting on it, instead of waiting as well
+IN_FLIGHT_TIMEOUT = 60 * 60
+# Limit on the total size of the cached results
+MAX_CACHE_BYTES = 256 << 20
+
+# Results of ResultCache.begin
+HIT = 'hit'         # The results are cached
+JOINED = 'joined'   # An identical run is in progress and will email them
+OWNER = 'owner'     # The results must be calculated
+
+# Run parameters that only affect who is emailed and how, rather than the
+# results
+REQUESTER_PARAMS = ('emails', 'run_name', 'user_args', 'timestamp')
+
+
+def result_key(params, inputs):
+    """Key of the results of a run with the given parameters and inputs. The
+    datafiles are identified by the hashes of their contents, and the run's
+    name is left out since it only appears in the names of the attachments"""
+    cfgs = [dict((k, v) for k, v in cfg.iteritems() if k != 'run_name')
+            for cfg in params['run_cfgs']]
+    return hashlib.sha1(json.dumps({
+        'datafile_keys': params['datafile_keys'],
+        'mapping_dict': inputs['mapping_dict'],
+        'make_relative': params['make_relative'],
+        'quantile_normalize': params['quantile_normalize'],
+        'quantile_ties': params['quantile_ties'],
+        'include_out': params.get('include_out'),
+        'run_cfgs': cfgs,
+    }, sort_keys=True)).hexdigest()
+
+
+def requester(params):
+    """The parameters of a run needed to email its results"""
+    return dict((k, params[k]) for k in REQUESTER_PARAMS)
+
+
+def rename_attachments(attachments, old_run_name, run_name):
+    """The attachments of a run named old_run_name renamed for a run named
+    run_name. Their file names end with the name of the run"""
+    renamed = list()
+    for attachment in attachments:
+        name, ext = os.path.splitext(attachment['Filename'])
+        if name.endswith('_' + old_run_name):
+            name = name[:len(name) - len(old_run_name)] + run_name
+        renamed.append(dict(attachment, Filename=name + ext))
+    return renamed
+
+
+def default_result_cache():
+    """The result cache shared by the runs. Kept in memory when the inputs
+    are kept in a local directory, and in the datastore otherwise"""
+    if os.getenv(LOCAL_STORE_VARIABLE):
+        return LOCAL_RESULT_CACHE
+    return DatastoreResultCache()
+
+
+def begin_entry(entry, who, run_id, now):
+    """Start the run with run_id for who on the cache entry for its key, which
+    is None if there isn't one. A run that is begun again, as when its task
+    is retried, gets the same state as the first time. Returns the new entry,
+    and the state of the run along with the entry"""
+    waiters = list()
+    if entry is not None:
+        if entry['done']:
+            if now - entry['time'] < RESULT_TTL:
+                entry['used'] = now
+                return entry, (HIT, entry)
+        elif entry['owner'] == run_id:
+            return entry, (OWNER, entry)
+        elif now - entry['time'] < IN_FLIGHT_TIMEOUT:
+            if run_id not in [w['run_id'] for w in entry['waiters']]:
+                entry['waiters'].append(dict(who, run_id=run_id))
+            return entry, (JOINED, entry)
+        else:   # The owner is presumed dead, so this run takes over
+            waiters = [w for w in entry['waiters'] if w['run_id'] != run_id]
+    entry = {'done': False, 'owner': run_id, 'time': now, 'used': now,
+             'waiters': waiters, 'size': 0, 'attachments_key': None,
+             'run_name': None}
+    return entry, (OWNER, entry)
+
+
+def finish_entry(entry, attachments_key, size, run_name, run_id, now):
+    """The new entry for a finished run, and the requesters that were waiting
+    on it"""
+    waiters = entry['waiters'] if entry is not None else []
+    return {'done': True, 'owner': run_id, 'time': now, 'used': now,
+            'waiters': [], 'size': size, 'attachments_key': attachments_key,
+            'run_name': run_name}, waiters
+
+
+def release_entry(entry, run_id):
+    """The entry once the run with run_id has finished without caching its
+    results, and the requesters waiting on it, who are sent the results by
+    that run rather than by whichever run owns the entry"""
+    if entry is None or entry['done']:
+        return entry, []
+    if entry['owner'] == run_id:
+        return None, entry['waiters']
+    return dict(entry, waiters=[]), entry['waiters']
+
+
+def abandon_entry(entry, run_id):
+    """The entry once the run with run_id has failed, and the requesters
+    waiting on it. The entry is left to a run that has taken it over"""
+    if entry is None or entry['done'] or entry['owner'] != run_id:
+        return entry, []
+    return None, entry['waiters']
+
+
+def remove_unchanged(expected):
+    """A change for ResultCache.update that removes the entry only if it is
+    still expected"""
+    return lambda entry: (None if entry == expected else entry, None)
+
+
+class ResultCache(object):
+    """Cache of the emailed attachments of runs, by result_key. Identical
+    runs that start while one is in progress wait for it rather than
+    calculating the same results. The attachments are kept in the input
+    store, while subclasses keep the entries describing them"""
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+
+    def begin(self, key, params, run_id):
+        """Start the run with the given parameters and id. Returns HIT and the
+        cached attachments renamed for the run, JOINED and None if an
+        identical run will email the results, or OWNER and None if the run
+        must calculate them and then call finish or abandon"""
+        state, entry = self.update(
+            key, lambda entry: begin_entry(entry, requester(params), run_id,
+                                           time.time()))
+        if state != HIT:
+            return state, None
+        with default_store().open(entry['attachments_key']) as f:
+            attachments = json.load(f)
+        return HIT, rename_attachments(attachments, entry['run_name'],
+                                       params['run_name'])
+
+    def finish(self, key, params, attachments, run_id):
+        """Cache the attachments of the run with the given parameters and id.
+        Returns a list of the requesters waiting on it, each a dictionary of
+        the parameters in REQUESTER_PARAMS, along with the attachments
+        renamed for each"""
+        content = json.dumps(attachments)
+        if len(content) > self.max_bytes:   # Too large to be worth keeping
+            waiters = self.update(key, lambda entry: release_entry(entry,
+                                                                   run_id))
+        else:
+            attachments_key = default_store().put(content)
+            waiters = self.update(key, lambda entry: finish_entry(
+                entry, attachments_key, len(content), params['run_name'],
+                run_id, time.time()))
+            self.evict(keep=key)
+        return [(who, rename_attachments(attachments, params['run_name'],
+                                         who['run_name']))
+                for who in waiters]
+
+    def abandon(self, key, run_id):
+        """Drop the entry of the run with run_id, which failed. Returns the
+        requesters that were waiting on it"""
+        return self.update(key, lambda entry: abandon_entry(entry, run_id))
+
+    def update(self, key, change):
+        """Atomically replace the entry for key, or None if there isn't one,
+        with the first of the pair returned by change(entry), removing it if
+        that is None. Returns the second of the pair"""
+        raise NotImplementedError
+
+    def evict(self, keep=None):
+        """Remove expired finished entries, and then the least recently used
+        finished entries other than keep until the cache is within
+        max_bytes. Their attachments are left to expire from the input
+        store, since a run that just read an entry may still be reading
+        them"""
+        raise NotImplementedError
+
+
+class LocalResultCache(ResultCache):
+    """Entries kept in the memory of this process. For testing"""
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        ResultCache.__init__(self, max_bytes)
+        self.lock = threading.Lock()
+        self.entries = dict()
+
+    def update(self, key, change):
+        with self.lock:
+            entry, result = change(self.entries.get(key))
+            if entry is None:
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = entry
+            return result
+
+    def evict(self, keep=None):
+        with self.lock:
+            self.entries = evicted(self.entries, keep, self.max_bytes,
+                                   time.time())
+
+
+def evicted(entries, keep, max_bytes, now):
+    """The given dictionary of entries without the finished ones that have
+    expired, and without the least recently used finished entries other than
+    keep beyond max_bytes. Runs in progress are kept, even once they have
+    timed out, so that their waiters are passed on to the run that takes them
+    over. Those that are never taken over are removed after RESULT_TTL"""
+    entries = dict((key, entry) for key, entry in entries.iteritems()
+                   if now - entry['time'] < RESULT_TTL)
+    total = sum(entry['size'] for entry in entries.itervalues())
+    for used, key in sorted((entry['used'], key)
+                            for key, entry in entries.iteritems()
+                            if entry['done'] and key != keep):
+        if total <= max_bytes:
+            break
+        total -= entries.pop(key)['size']
+    return entries
+
+
+if ndb is not None:
+    class CachedResult(ndb.Model):
+        """Datastore entity holding a ResultCache entry"""
+        entry = ndb.JsonProperty(compressed=True)
+
+
+class DatastoreResultCache(ResultCache):
+    """Entries kept in the datastore, so that they are shared by every
+    instance"""
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        if ndb is None:
+            raise ValueError('The datastore is not available')
+        ResultCache.__init__(self, max_bytes)
+
+    def update(self, key, change):
+        @ndb.transactional
+        def txn():
+            stored = CachedResult.get_by_id(key)
+            entry, result = change(stored.entry if stored else None)
+            if entry is None:
+                if stored is not None:
+                    stored.key.delete()
+            else:
+                CachedResult(id=key, entry=entry).put()
+            return result
+        return txn()
+
+    def evict(self, keep=None):
+        # The query is only eventually consistent, so each entry it finds to
+        # remove is removed in its own transaction, and only if it has not
+        # changed since
+        stored = dict((result.key.id(), result.entry)
+                      for result in CachedResult.query())
+        kept = evicted(stored, keep, self.max_bytes, time.time())
+        for key, entry in stored.iteritems():
+            if key not in kept:
+                self.update(key, remove_unchanged(entry))
+
+
+LOCAL_RESULT_CACHE = LocalResultCache()
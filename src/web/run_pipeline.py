@@ -17,67 +17,25 @@
 # along with Coremic. If not, see <http://www.gnu.org/licenses/>.
 import logging
 import pipeline
-import cPickle
-import base64
-from datetime import datetime
-from time import strptime, mktime
 
-from send_email import send_email
-from generate_graph import generate_graph
-from ..core.process_data import process, format_results
-
-
-SUCCESS_EMAIL_SUBJ = 'Your data with name %s has been processed'
-SUCCESS_EMAIL = '''Dear User:
-
-Your data has been processed and is attached. Thanks for using this tool.
-
-Please email us if you have any questions.
-
-The Core Microbiome Team
-
-%s
-Elapsed time: %d.%06d seconds'''
-FAILURE_EMAIL_SUBJ = 'There was an error in processing your data with name %s'
-FAILURE_EMAIL = '''Dear User:
-
-There was an error in processing your data. The error is listed below.
-
-Please email us if you have any questions.
-
-The Core Microbiome Team
-
-%s
-Elapsed time %d.%06d seconds
-
-%s'''
+from stages import (begin_stage, parse_stage, process_stage, report_stage,
+                    fail_run)
 
 
 class RunPipeline(pipeline.Pipeline):
+    """Reads the uploaded datafiles, then finds and emails the cores. Reading
+    the datafiles is its own stage, so that it happens here rather than in
+    the request that starts the run, and the OTUs of the table are split in
+    to shards that are processed by parallel stages before the results are
+    gathered for the multiple testing correction and the report"""
     def run(self, params, inputs):
         logging.info('Starting run')
-        # Unpack the data
-        inputs['filtered_data'] = cPickle.loads(str(inputs['filtered_data']))
-
-        attachments = list()
-        for cfg in params['run_cfgs']:
-            core = process(inputs, cfg)
-            attachments.append({'Content-Type': 'text/plain',
-                                'Filename': '%s_results_%s.tsv' % (
-                                    cfg['name'], cfg['run_name']
-                                ),
-                                'content': base64.b64encode(
-                                    format_results(core, cfg)
-                                )})
-            attachments += generate_graph(inputs, cfg, core)
-        elapsed_time = datetime.now() - datetime.fromtimestamp(mktime(
-            strptime(params['timestamp'], '%a-%d-%b-%Y-%I:%M:%S-%p')))
-        for email in params['emails']:
-            send_email(SUCCESS_EMAIL_SUBJ % params['run_name'],
-                       SUCCESS_EMAIL % (params['user_args'],
-                                        elapsed_time.seconds,
-                                        elapsed_time.microseconds),
-                       email, attachments)
+        # The run is known to the result cache, and its temporary objects in
+        # the input store are named, by its id
+        if not begin_stage(params, self.pipeline_id):
+            return
+        ranges = yield ParseInputs(params, inputs, self.pipeline_id)
+        yield ProcessInputs(params, inputs, self.pipeline_id, ranges)
 
     def finalized(self):
         logging.info('Finalizing task')
@@ -87,14 +45,33 @@ class RunPipeline(pipeline.Pipeline):
             error = 'An unknown error has occured. Please try again. ' +\
                     'If this occurs again please contact the developers'
             logging.warn(error)
-            elapsed_time = datetime.now() - datetime.fromtimestamp(mktime(
-                strptime(params['timestamp'], '%a-%d-%b-%Y-%I:%M:%S-%p')))
-            for email in params['emails']:
-                send_email(FAILURE_EMAIL_SUBJ % params['run_name'],
-                           FAILURE_EMAIL % (
-                               params['user_args'],
-                               elapsed_time.seconds,
-                               elapsed_time.microseconds,
-                               error),
-                           email)
+            fail_run(params, error, self.pipeline_id)
         self.cleanup()
+
+
+class ParseInputs(pipeline.Pipeline):
+    def run(self, params, inputs, run_id):
+        return parse_stage(params, inputs, run_id)
+
+
+class ProcessInputs(pipeline.Pipeline):
+    """Fans the shards of the table out to a ProcessShard each, then gathers
+    their results in a ReportResults"""
+    def run(self, params, inputs, run_id, ranges):
+        if ranges is None:      # The errors have already been emailed
+            return
+        shard_keys = list()
+        for shard, (start, end) in enumerate(ranges):
+            shard_keys.append((yield ProcessShard(params, inputs, run_id,
+                                                  shard, start)))
+        yield ReportResults(params, inputs, run_id, *shard_keys)
+
+
+class ProcessShard(pipeline.Pipeline):
+    def run(self, params, inputs, run_id, shard, start):
+        return process_stage(params, inputs, run_id, shard, start)
+
+
+class ReportResults(pipeline.Pipeline):
+    def run(self, params, inputs, run_id, *shard_keys):
+        report_stage(params, inputs, run_id, shard_keys)
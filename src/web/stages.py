@@ -0,0 +1,232 @@
+# Copyright 2016, 2017 Richard Rodrigues, Nyle Rodgers, Mark Williams,
+# Virginia Tech
+#
+# This file is part of Coremic.
+#
+# Coremic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Coremic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Coremic. If not, see <http://www.gnu.org/licenses/>.
+
+# The stages of RunPipeline, which are kept apart from the pipeline library
+# so that they can also be run without it by run_local
+
+
+import json
+import uuid
+import logging
+import base64
+from datetime import datetime
+from time import strptime, mktime
+
+from send_email import send_email
+from generate_graph import generate_graph
+from input_store import default_store
+from result_cache import default_result_cache, HIT, OWNER
+from ..core.parse_inputs import read_inputs
+from ..core.process_data import (shard_ranges, process_shard, gather_shards,
+                                 encode_shard, decode_shard, format_results)
+from ..core.pval import PVAL_CACHE
+from ..core.table import Table
+
+# Number of entries of the table in each shard of a run, which bounds the
+# memory each shard's stage needs, since it only reads its own shard
+SHARD_CELLS = 1 << 22
+
+SUCCESS_EMAIL_SUBJ = 'Your data with name %s has been processed'
+SUCCESS_EMAIL = '''Dear User:
+
+Your data has been processed and is attached. Thanks for using this tool.
+
+Please email us if you have any questions.
+
+The Core Microbiome Team
+
+%s
+Elapsed time: %d.%06d seconds'''
+FAILURE_EMAIL_SUBJ = 'There was an error in processing your data with name %s'
+FAILURE_EMAIL = '''Dear User:
+
+There was an error in processing your data. The error is listed below.
+
+Please email us if you have any questions.
+
+The Core Microbiome Team
+
+%s
+Elapsed time %d.%06d seconds
+
+%s'''
+
+
+def run_local(params, inputs):
+    """Run the stages one after another in this process, as RunPipeline runs
+    them as stages of the pipeline library. For testing"""
+    run_id = uuid.uuid4().hex
+    if not begin_stage(params, run_id):
+        return
+    ranges = parse_stage(params, inputs, run_id)
+    if ranges is None:
+        return
+    shard_keys = [process_stage(params, inputs, run_id, shard, start)
+                  for shard, (start, end) in enumerate(ranges)]
+    report_stage(params, inputs, run_id, shard_keys)
+
+
+def begin_stage(params, run_id):
+    """Checks the result cache for the results of an identical run. Returns
+    whether the run with run_id must calculate them, which it doesn't if they
+    were cached, in which case they are emailed to the users, or if an
+    identical run is in progress, which will email them"""
+    if params.get('result_key') is None:
+        return True
+    state, attachments = default_result_cache().begin(params['result_key'],
+                                                      params, run_id)
+    logging.info('Result cache: %s', state)
+    if state == HIT:
+        send_success(params, attachments)
+    return state == OWNER
+
+
+def parse_stage(params, inputs, run_id):
+    """Reads the datafiles in the input store in to a single table, and
+    splits its rows in to shards of about params['shard_cells'] entries,
+    defaulting to SHARD_CELLS. Each shard is put in the store on its own, as
+    are the ids of the OTUs, so that the later stages only read what they
+    need. Returns the (start, end) range of rows of each shard, or None if
+    the datafiles could not be read, in which case the errors are emailed to
+    the users"""
+    store = default_store()
+    datafiles = [store.open(key) for key in params['datafile_keys']]
+    try:
+        errors_list, table = read_inputs(params, inputs['mapping_dict'],
+                                         datafiles)
+    finally:
+        for f in datafiles:
+            f.close()
+    if errors_list:
+        logging.warn(errors_list)
+        fail_run(params, '\n'.join(errors_list), run_id)
+        return None
+    ranges = shard_ranges(table.shape, params.get('shard_cells', SHARD_CELLS))
+    for shard, (start, end) in enumerate(ranges):
+        store.put(table.rows(start, end).to_bytes(),
+                  run_key(run_id, 'table_%d' % shard))
+    store.put(json.dumps(table.observation_ids), run_key(run_id, 'ids'))
+    return ranges
+
+
+def process_stage(params, inputs, run_id, shard, start):
+    """Counts and calculates the p-values of the OTUs of the given shard of
+    the table, which starts at row start, for each of the run configurations.
+    Returns the key the results are stored under"""
+    store = default_store()
+    table = load_table(store, run_key(run_id, 'table_%d' % shard))
+    inputs = dict(inputs, filtered_data=table)
+    end = len(table.observation_ids)
+    if params.get('include_out'):
+        # The second run is the first with the groups swapped, so both
+        # come from the same counts
+        results = process_shard(inputs, params['run_cfgs'][0], 0, end,
+                                symmetric=True)
+    else:
+        results = [side for cfg in params['run_cfgs']
+                   for side in process_shard(inputs, cfg, 0, end)]
+    # The candidates are indexed by their rows in the whole table
+    for pvals, otus in results:
+        otus.columns['index'] += start
+    logging.info('p-value cache: %(hits)d hits, %(misses)d misses, '
+                 '%(size)d of %(max_size)d entries', PVAL_CACHE.info())
+    return store.put(encode_shard(results),
+                     run_key(run_id, 'result_%d' % shard))
+
+
+def report_stage(params, inputs, run_id, shard_keys):
+    """Gathers the results of every shard to find the cores, and emails them
+    to the users. The run's objects in the input store are then deleted"""
+    store = default_store()
+    with store.open(run_key(run_id, 'ids')) as f:
+        observation_ids = json.load(f)
+    shards = list()
+    for key in shard_keys:
+        with store.open(key) as f:
+            shards.append(decode_shard(f.read(), observation_ids))
+
+    attachments = list()
+    for side, cfg in enumerate(params['run_cfgs']):
+        core = gather_shards([shard[side] for shard in shards], cfg)
+        attachments.append({'Content-Type': 'text/plain',
+                            'Filename': '%s_results_%s.tsv' % (
+                                cfg['name'], cfg['run_name']
+                            ),
+                            'content': base64.b64encode(
+                                format_results(core, cfg)
+                            )})
+        attachments += generate_graph(inputs, cfg, core)
+    send_success(params, attachments)
+    if params.get('result_key') is not None:
+        # Identical runs that started while this one was in progress
+        for waiter, renamed in default_result_cache().finish(
+                params['result_key'], params, attachments, run_id):
+            send_success(waiter, renamed)
+    for shard, key in enumerate(shard_keys):
+        store.delete(run_key(run_id, 'table_%d' % shard))
+        store.delete(key)
+    store.delete(run_key(run_id, 'ids'))
+
+
+def run_key(run_id, name):
+    """Key in the input store of the temporary object with the given name of
+    the run with the given id. Unlike inputs, which are named by the hashes
+    of their contents, these are never shared with another run"""
+    return '%s_%s' % (run_id, name)
+
+
+def load_table(store, key):
+    """The table stored under key in the given input store"""
+    with store.open(key) as f:
+        return Table.from_bytes(f.read())
+
+
+def fail_run(params, error, run_id):
+    """Email the users of the run with run_id, and of any identical runs
+    waiting on it, that it failed with the given error"""
+    send_failure(params, error)
+    if params.get('result_key') is not None:
+        for waiter in default_result_cache().abandon(params['result_key'],
+                                                     run_id):
+            send_failure(waiter, error)
+
+
+def send_success(params, attachments):
+    """Email the users the attachments of their finished run"""
+    elapsed_time = datetime.now() - datetime.fromtimestamp(mktime(
+        strptime(params['timestamp'], '%a-%d-%b-%Y-%I:%M:%S-%p')))
+    for email in params['emails']:
+        send_email(SUCCESS_EMAIL_SUBJ % params['run_name'],
+                   SUCCESS_EMAIL % (params['user_args'],
+                                    elapsed_time.seconds,
+                                    elapsed_time.microseconds),
+                   email, attachments)
+
+
+def send_failure(params, error):
+    """Email the users that their run failed with the given error"""
+    elapsed_time = datetime.now() - datetime.fromtimestamp(mktime(
+        strptime(params['timestamp'], '%a-%d-%b-%Y-%I:%M:%S-%p')))
+    for email in params['emails']:
+        send_email(FAILURE_EMAIL_SUBJ % params['run_name'],
+                   FAILURE_EMAIL % (
+                       params['user_args'],
+                       elapsed_time.seconds,
+                       elapsed_time.microseconds,
+                       error),
+                   email)
@@ -0,0 +1,105 @@
+# Copyright 2016, 2017 Richard Rodrigues, Nyle Rodgers, Mark Williams,
+# Virginia Tech
+#
+# This file is part of Coremic.
+#
+# Coremic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Coremic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Coremic. If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import unittest
+from StringIO import StringIO
+from collections import OrderedDict
+import numpy
+
+from src.core.parse_biom import parse_json_biom
+
+# Chunk sizes small enough that numbers, the ends of the data arrays, and
+# the commas between them are split across reads
+CHUNK_SIZES = (1, 2, 3, 7, 1 << 20)
+
+ROWS = [{'id': 'o1', 'metadata': {'taxonomy': ['k__A', 'p__B']}},
+        {'id': 'o2', 'metadata': {'taxonomy': ['k__A', 'p__C']}},
+        {'id': 'o3', 'metadata': None}]
+COLUMNS = [{'id': 's1', 'metadata': None}, {'id': 's2', 'metadata': None},
+           {'id': 's3', 'metadata': None}, {'id': 's4', 'metadata': None}]
+SPARSE_DATA = [[0, 0, 12.5], [0, 3, 1e-3], [1, 1, 100], [2, 0, 7],
+               [2, 2, 123456789.25]]
+DENSE_DATA = [[12.5, 0, 0, 0.001], [0, 100, 0, 0], [7, 0, 123456789.25, 0]]
+
+
+def biom_json(matrix_type, data, fields_first=('shape',), **dump_args):
+    """A BIOM file of ROWS and COLUMNS with the given data. The fields in
+    fields_first are written before the data and the rest after it"""
+    fields = [('id', 'test'), ('format', 'Biological Observation Matrix'),
+              ('matrix_type', matrix_type), ('rows', ROWS),
+              ('columns', COLUMNS), ('shape', [len(ROWS), len(COLUMNS)])]
+    fields = ([field for field in fields if field[0] in fields_first] +
+              [('data', data)] +
+              [field for field in fields if field[0] not in fields_first])
+    return json.dumps(OrderedDict(fields), **dump_args)
+
+
+def expected_matrix(text):
+    """The dense matrix of the BIOM file text, decoded with json.loads"""
+    biom = json.loads(text)
+    matrix = numpy.zeros(biom['shape'])
+    if biom['matrix_type'] == 'sparse':
+        for row, column, value in biom['data']:
+            matrix[row, column] = value
+    elif biom['data']:
+        matrix[:, :] = biom['data']
+    return biom, matrix
+
+
+class JsonBiomTest(unittest.TestCase):
+    def check(self, text):
+        biom, matrix = expected_matrix(text)
+        for chunk_size in CHUNK_SIZES:
+            parsed = parse_json_biom(StringIO(text), chunk_size)
+            self.assertEqual(parsed.sample_ids,
+                             [column['id'] for column in biom['columns']])
+            self.assertEqual(parsed.observation_ids,
+                             [row['id'] for row in biom['rows']])
+            self.assertEqual(parsed.observation_metadata,
+                             [row['metadata'] or dict()
+                              for row in biom['rows']])
+            self.assertEqual(parsed.shape, tuple(biom['shape']))
+            parsed_matrix = numpy.zeros(parsed.shape)
+            parsed_matrix[parsed.rows, parsed.columns] = parsed.values
+            self.assertTrue((parsed_matrix == matrix).all(),
+                            'chunk_size %d' % chunk_size)
+
+    def test_sparse(self):
+        self.check(biom_json('sparse', SPARSE_DATA))
+
+    def test_dense(self):
+        self.check(biom_json('dense', DENSE_DATA))
+
+    def test_indented(self):
+        self.check(biom_json('sparse', SPARSE_DATA, indent=4))
+        self.check(biom_json('dense', DENSE_DATA, indent=2))
+
+    def test_empty_data(self):
+        self.check(biom_json('sparse', []))
+        self.check(biom_json('sparse', [], indent=4))
+
+    def test_data_before_shape(self):
+        self.check(biom_json('sparse', SPARSE_DATA, fields_first=()))
+        self.check(biom_json('dense', DENSE_DATA, fields_first=(),
+                             indent=4))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# Copyright 2016, 2017 Richard Rodrigues, Nyle Rodgers, Mark Williams,
+# Virginia Tech
+#
+# This file is part of Coremic.
+#
+# Coremic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Coremic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Coremic. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+import numpy
+
+from src.core.parse_biom import parse_biom, check_biom, h5py, HDF5_SIGNATURE
+from src.core.parse_inputs import read_table
+
+SAMPLE_IDS = ['s1', 's2', 's3']
+OBSERVATION_IDS = ['o1', 'o2', 'o3']
+TAXONOMY = [['k__A', 'p__B'], ['k__A', 'p__C'], ['k__A', 'p__B']]
+MATRIX = numpy.array([[1., 0., 2.],
+                      [0., 3., 0.],
+                      [4., 5., 0.]])
+
+
+def write_compressed(group, matrix):
+    """Write the rows of matrix to group as a compressed sparse matrix"""
+    rows, columns = matrix.nonzero()
+    group['data'] = matrix[rows, columns]
+    group['indices'] = columns.astype('int32')
+    group['indptr'] = numpy.append(0, numpy.cumsum(numpy.bincount(
+        rows, minlength=matrix.shape[0]))).astype('int32')
+
+
+def write_hdf5_biom(path, taxonomy=True):
+    """Write MATRIX to path as a BIOM 2.1 file"""
+    strings = h5py.special_dtype(vlen=unicode)
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('observation/ids', data=OBSERVATION_IDS,
+                         dtype=strings)
+        f.create_dataset('sample/ids', data=SAMPLE_IDS, dtype=strings)
+        write_compressed(f.create_group('observation/matrix'), MATRIX)
+        write_compressed(f.create_group('sample/matrix'), MATRIX.T)
+        if taxonomy:
+            f.create_dataset('observation/metadata/taxonomy', data=TAXONOMY,
+                             dtype=strings)
+
+
+@unittest.skipIf(h5py is None, 'h5py is not installed')
+class Hdf5BiomTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'table.biom')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def parse(self, sample_ids=None):
+        with open(self.path, 'rb') as f:
+            return parse_biom(f, sample_ids)
+
+    def test_round_trip(self):
+        write_hdf5_biom(self.path)
+        biom = self.parse()
+        self.assertEqual(biom.sample_ids, SAMPLE_IDS)
+        self.assertEqual(biom.observation_ids, OBSERVATION_IDS)
+        self.assertEqual([md['taxonomy'] for md in biom.observation_metadata],
+                         TAXONOMY)
+        matrix = numpy.zeros(biom.shape)
+        matrix[biom.rows, biom.columns] = biom.values
+        self.assertTrue((matrix == MATRIX).all())
+        self.assertTrue((biom.sample_totals == MATRIX.sum(axis=0)).all())
+
+    def test_sample_ids(self):
+        write_hdf5_biom(self.path)
+        biom = self.parse(set(['s1', 's3']))
+        self.assertEqual(biom.sample_ids, ['s1', 's3'])
+        matrix = numpy.zeros(biom.shape)
+        matrix[biom.rows, biom.columns] = biom.values
+        self.assertTrue((matrix == MATRIX[:, [0, 2]]).all())
+
+    def test_read_table(self):
+        write_hdf5_biom(self.path)
+        with open(self.path, 'rb') as f:
+            table = read_table(f)
+        self.assertEqual(table.observation_ids, ['k__A;p__B', 'k__A;p__C'])
+        self.assertTrue((table.dense() ==
+                         [MATRIX[0] + MATRIX[2], MATRIX[1]]).all())
+
+    def test_no_taxonomy(self):
+        write_hdf5_biom(self.path, taxonomy=False)
+        self.assertRaises(ValueError, self.parse)
+
+
+class CheckBiomTest(unittest.TestCase):
+    def test_json(self):
+        check_biom(StringIO('  {"id": null}'), allow_hdf5=False)
+        self.assertRaises(ValueError, check_biom, StringIO('#OTU ID\ts1'))
+        self.assertRaises(ValueError, check_biom, StringIO(''))
+
+    def test_hdf5(self):
+        f = StringIO(HDF5_SIGNATURE + '\0' * 8)
+        check_biom(f)
+        self.assertEqual(f.tell(), 0)
+        self.assertRaises(ValueError, check_biom, f, allow_hdf5=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+# Copyright 2016, 2017 Richard Rodrigues, Nyle Rodgers, Mark Williams,
+# Virginia Tech
+#
+# This file is part of Coremic.
+#
+# Coremic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Coremic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Coremic. If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+from src.web.result_cache import (begin_entry, finish_entry, release_entry,
+                                  abandon_entry, remove_unchanged, evicted,
+                                  HIT, JOINED, OWNER, RESULT_TTL,
+                                  IN_FLIGHT_TIMEOUT)
+
+NOW = 1000000.0
+
+
+def who(name):
+    """The requester parameters of a run named name"""
+    return {'emails': ['%s@example.com' % name], 'run_name': name,
+            'user_args': '', 'timestamp': ''}
+
+
+def in_flight(owner, waiters=(), age=0):
+    """An entry of a run by owner started age seconds ago, with the given
+    waiting run ids"""
+    entry, (state, entry) = begin_entry(None, who(owner), owner, NOW - age)
+    entry['waiters'] = [dict(who(w), run_id=w) for w in waiters]
+    return entry
+
+
+def finished(owner, size=10, age=0, used=None):
+    """An entry of a run by owner that finished age seconds ago"""
+    entry, waiters = finish_entry(in_flight(owner), 'attachments', size,
+                                  owner, owner, NOW - age)
+    if used is not None:
+        entry['used'] = used
+    return entry
+
+
+def waiter_ids(entry):
+    return [w['run_id'] for w in entry['waiters']]
+
+
+class BeginEntryTest(unittest.TestCase):
+    def test_new(self):
+        entry, (state, returned) = begin_entry(None, who('a'), 'a', NOW)
+        self.assertEqual(state, OWNER)
+        self.assertEqual(entry['owner'], 'a')
+        self.assertFalse(entry['done'])
+        self.assertEqual(entry['waiters'], [])
+
+    def test_hit(self):
+        entry, (state, returned) = begin_entry(
+            finished('a', age=RESULT_TTL - 1), who('b'), 'b', NOW)
+        self.assertEqual(state, HIT)
+        self.assertEqual(entry['used'], NOW)
+        self.assertEqual(entry['owner'], 'a')
+
+    def test_expired(self):
+        entry, (state, returned) = begin_entry(
+            finished('a', age=RESULT_TTL + 1), who('b'), 'b', NOW)
+        self.assertEqual(state, OWNER)
+        self.assertEqual(entry['owner'], 'b')
+        self.assertFalse(entry['done'])
+
+    def test_join(self):
+        entry, (state, returned) = begin_entry(in_flight('a'), who('b'), 'b',
+                                               NOW)
+        self.assertEqual(state, JOINED)
+        self.assertEqual(entry['owner'], 'a')
+        self.assertEqual(entry['waiters'], [dict(who('b'), run_id='b')])
+        # Begun again, as when the run's task is retried
+        entry, (state, returned) = begin_entry(entry, who('b'), 'b', NOW)
+        self.assertEqual(state, JOINED)
+        self.assertEqual(waiter_ids(entry), ['b'])
+
+    def test_retried_owner(self):
+        entry, (state, returned) = begin_entry(in_flight('a', ['b']),
+                                               who('a'), 'a', NOW)
+        self.assertEqual(state, OWNER)
+        self.assertEqual(entry['owner'], 'a')
+        self.assertEqual(waiter_ids(entry), ['b'])
+
+    def test_takeover(self):
+        entry, (state, returned) = begin_entry(
+            in_flight('a', ['b', 'c'], age=IN_FLIGHT_TIMEOUT + 1), who('c'),
+            'c', NOW)
+        self.assertEqual(state, OWNER)
+        self.assertEqual(entry['owner'], 'c')
+        self.assertEqual(entry['time'], NOW)
+        # The new owner no longer waits on itself
+        self.assertEqual(waiter_ids(entry), ['b'])
+
+
+class EndEntryTest(unittest.TestCase):
+    def test_finish(self):
+        entry, waiters = finish_entry(in_flight('a', ['b']), 'key', 10, 'a',
+                                      'a', NOW)
+        self.assertTrue(entry['done'])
+        self.assertEqual(entry['attachments_key'], 'key')
+        self.assertEqual(entry['waiters'], [])
+        self.assertEqual([w['run_id'] for w in waiters], ['b'])
+
+    def test_release(self):
+        entry, waiters = release_entry(in_flight('a', ['b']), 'a')
+        self.assertEqual(entry, None)
+        self.assertEqual([w['run_id'] for w in waiters], ['b'])
+
+    def test_release_taken_over(self):
+        # The run that took over keeps the entry, but the waiters are sent
+        # the results of the run that finished
+        entry, waiters = release_entry(in_flight('c', ['b']), 'a')
+        self.assertEqual(entry['owner'], 'c')
+        self.assertEqual(entry['waiters'], [])
+        self.assertEqual([w['run_id'] for w in waiters], ['b'])
+
+    def test_release_finished(self):
+        done = finished('c')
+        self.assertEqual(release_entry(done, 'a'), (done, []))
+
+    def test_abandon(self):
+        entry, waiters = abandon_entry(in_flight('a', ['b']), 'a')
+        self.assertEqual(entry, None)
+        self.assertEqual([w['run_id'] for w in waiters], ['b'])
+
+    def test_abandon_taken_over(self):
+        # The waiters are left to the run that took over
+        owned = in_flight('c', ['b'])
+        entry, waiters = abandon_entry(owned, 'a')
+        self.assertEqual(entry, owned)
+        self.assertEqual(waiter_ids(entry), ['b'])
+        self.assertEqual(waiters, [])
+
+    def test_abandon_finished(self):
+        done = finished('c')
+        self.assertEqual(abandon_entry(done, 'a'), (done, []))
+        self.assertEqual(abandon_entry(None, 'a'), (None, []))
+
+    def test_remove_unchanged(self):
+        entry = finished('a')
+        self.assertEqual(remove_unchanged(dict(entry))(entry), (None, None))
+        changed = dict(entry, used=NOW + 1)
+        self.assertEqual(remove_unchanged(entry)(changed), (changed, None))
+
+
+class EvictedTest(unittest.TestCase):
+    def test_expired(self):
+        entries = {'old': finished('a', age=RESULT_TTL + 1),
+                   'new': finished('b', age=RESULT_TTL - 1),
+                   'slow': in_flight('c', ['d'], age=IN_FLIGHT_TIMEOUT + 1),
+                   'dead': in_flight('e', age=RESULT_TTL + 1)}
+        self.assertEqual(sorted(evicted(entries, None, 100, NOW)),
+                         ['new', 'slow'])
+
+    def test_least_recently_used(self):
+        entries = {'a': finished('a', size=40, used=NOW - 3),
+                   'b': finished('b', size=40, used=NOW - 1),
+                   'c': finished('c', size=40, used=NOW - 2),
+                   'd': in_flight('d', ['e'], age=IN_FLIGHT_TIMEOUT + 1)}
+        self.assertEqual(sorted(evicted(entries, None, 80, NOW)),
+                         ['b', 'c', 'd'])
+        self.assertEqual(sorted(evicted(entries, None, 40, NOW)), ['b', 'd'])
+        # keep is never removed, even if it is the least recently used
+        self.assertEqual(sorted(evicted(entries, 'a', 40, NOW)), ['a', 'd'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# Copyright 2016, 2017 Richard Rodrigues, Nyle Rodgers, Mark Williams,
+# Virginia Tech
+#
+# This file is part of Coremic.
+#
+# Coremic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Coremic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Coremic. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import types
+import base64
+import shutil
+import tempfile
+import unittest
+
+from src.core.parse_inputs import validate_inputs, read_inputs
+from src.core.process_data import process, format_results
+
+# Emails are collected here instead of being sent
+sent = list()
+send_email = types.ModuleType('src.web.send_email')
+send_email.send_email = lambda subj, msg, to_email, attachments=[]: \
+    sent.append((subj, to_email, attachments))
+sys.modules['src.web.send_email'] = send_email
+
+# The graphs need the App Engine libraries
+try:
+    from src.web import stages
+    from src.web.input_store import LOCAL_STORE_VARIABLE, default_store
+except ImportError:
+    stages = None
+
+SAMPLE_DATA = os.path.join(os.path.dirname(__file__), '..', 'static',
+                           'sample_data')
+GROUPFILE = os.path.join(SAMPLE_DATA, 'switchgrass.txt')
+DATAFILE = os.path.join(SAMPLE_DATA, 'switchgrass.biom')
+
+
+@unittest.skipIf(stages is None, 'The App Engine libraries are not installed')
+class RunLocalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.old_directory = os.environ.get(LOCAL_STORE_VARIABLE)
+        os.environ[LOCAL_STORE_VARIABLE] = self.directory
+        del sent[:]
+
+    def tearDown(self):
+        if self.old_directory is None:
+            del os.environ[LOCAL_STORE_VARIABLE]
+        else:
+            os.environ[LOCAL_STORE_VARIABLE] = self.old_directory
+        shutil.rmtree(self.directory)
+
+    def run_params(self, include_out):
+        """The params and inputs of a run as MainPage starts it"""
+        params = {
+            'run_name': 'test', 'emails': ['user@example.com'],
+            'timestamp': 'Mon-01-Jan-2018-01:00:00-AM', 'user_args': '',
+            'factor': 'Plant', 'group': ['Sw'], 'max_p': 0.05,
+            'min_frac': 0.9, 'max_out_presence': 1.0,
+            'make_relative': False, 'quantile_normalize': False,
+            'quantile_ties': 'first', 'include_out': include_out,
+            'shard_cells': 1000,
+        }
+        with open(GROUPFILE) as f:
+            errors_list, mapping_dict, out_group = validate_inputs(
+                params, f.read().split('\n'))
+        self.assertEqual(errors_list, [])
+        cfg = dict(params, out_group=out_group, group_name='Sw',
+                   out_group_name='Gr', name='Sw', min_abundance=0.0,
+                   p_val_adj='b-h', top=None)
+        params['run_cfgs'] = [cfg]
+        if include_out:
+            params['run_cfgs'].append(dict(
+                cfg, group=out_group, out_group=['Sw'], group_name='Gr',
+                out_group_name='Sw', name='Gr'))
+        with open(DATAFILE, 'rb') as f:
+            params['datafile_keys'] = [default_store().put(f)]
+        return params, {'mapping_dict': mapping_dict}
+
+    def check(self, include_out):
+        params, inputs = self.run_params(include_out)
+        stages.run_local(params, inputs)
+        self.assertEqual(len(sent), 1)
+        subj, to_email, attachments = sent[0]
+        self.assertEqual(subj, stages.SUCCESS_EMAIL_SUBJ % 'test')
+        results = dict((attachment['Filename'],
+                        base64.b64decode(attachment['content']))
+                       for attachment in attachments)
+
+        with open(DATAFILE, 'rb') as f:
+            errors_list, table = read_inputs(params, inputs['mapping_dict'],
+                                             [f])
+        inputs = dict(inputs, filtered_data=table)
+        # The table is split in to several shards
+        self.assertTrue(table.shape[0] * table.shape[1] > 2000)
+        for cfg in params['run_cfgs']:
+            self.assertEqual(results['%s_results_test.tsv' % cfg['name']],
+                             format_results(process(inputs, cfg), cfg))
+        # Only the upload is left in the store
+        self.assertEqual(os.listdir(self.directory),
+                         params['datafile_keys'])
+
+    def test_interest_group(self):
+        self.check(include_out=False)
+
+    def test_include_out(self):
+        self.check(include_out=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
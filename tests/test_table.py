@@ -0,0 +1,74 @@
+# Copyright 2016, 2017 Richard Rodrigues, Nyle Rodgers, Mark Williams,
+# Virginia Tech
+#
+# This file is part of Coremic.
+#
+# Coremic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Coremic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Coremic. If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import numpy
+
+from src.core.table import Table, HEADER, MAGIC, VERSION
+
+SAMPLE_IDS = [u's1', u'\xe9chantillon', u'\u6837\u54c1']
+OBSERVATION_IDS = [u'k__A;p__\u03b2', u'k__A;p__C', u'k__D']
+# The second row is empty
+MATRIX = numpy.array([[1.5, 0., 2.],
+                      [0., 0., 0.],
+                      [4., 5.25, 0.]])
+
+
+class TableBytesTest(unittest.TestCase):
+    def setUp(self):
+        self.table = Table.from_dense(MATRIX, SAMPLE_IDS, OBSERVATION_IDS)
+        self.payload = self.table.to_bytes()
+
+    def test_round_trip(self):
+        table = Table.from_bytes(self.payload)
+        self.assertEqual(table.sample_ids, SAMPLE_IDS)
+        self.assertEqual(table.observation_ids, OBSERVATION_IDS)
+        self.assertEqual(table.shape, MATRIX.shape)
+        self.assertTrue((table.dense() == MATRIX).all())
+        self.assertEqual(list(table.indptr), [0, 2, 2, 4])
+
+    def test_rows(self):
+        table = Table.from_bytes(self.table.rows(1, 3).to_bytes())
+        self.assertEqual(table.observation_ids, OBSERVATION_IDS[1:])
+        self.assertTrue((table.dense() == MATRIX[1:]).all())
+
+    def test_truncated(self):
+        self.assertRaises(ValueError, Table.from_bytes,
+                          self.payload[:HEADER.size - 1])
+        self.assertRaises(ValueError, Table.from_bytes, self.payload[:-4])
+
+    def test_wrong_magic(self):
+        self.assertRaises(ValueError, Table.from_bytes,
+                          'XXXX' + self.payload[len(MAGIC):])
+
+    def test_wrong_version(self):
+        self.assertRaises(ValueError, Table.from_bytes,
+                          self.payload[:len(MAGIC)] + chr(VERSION + 1) +
+                          self.payload[len(MAGIC) + 1:])
+
+    def test_corrupt_body(self):
+        middle = HEADER.size + (len(self.payload) - HEADER.size) // 2
+        corrupt = (self.payload[:middle] +
+                   chr(ord(self.payload[middle]) ^ 0xff) +
+                   self.payload[middle + 1:])
+        self.assertRaises(ValueError, Table.from_bytes, corrupt)
+
+
+if __name__ == '__main__':
+    unittest.main()